@@ -0,0 +1,197 @@
+"""Columnar hourly consumption of HydroQuebec contracts and its vectorized aggregates."""
+from datetime import timedelta
+import logging
+
+import numpy as np
+
+from .consumption import HOURLY_FIELDS, KIND_HOURLY, day_from_string
+
+_LOGGER = logging.getLogger(__name__)
+
+HOURS = 24
+DEFAULT_ROLLING_DAYS = 7
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+# Days summarized for the sensors
+SUMMARY_DAYS = 365
+
+
+class HydroQuebecHourlyColumns:
+    """Hourly data of a contract, one contiguous float array per field indexed by hour offset
+
+    Offset 0 is midnight of the first day and missing hours are NaN, so a period
+    is a slice and its days are the rows of a (days, 24) view, without copying.
+    """
+
+    def __init__(self):
+        """Initialize empty columns."""
+        self.origin = None
+        self.days = 0
+        self._columns = {field: np.empty(0) for field in HOURLY_FIELDS}
+
+    @property
+    def last_day(self):
+        """Return the last day (date) covered, None if empty."""
+        return None if self.origin is None else self.origin + timedelta(days=self.days - 1)
+
+    def _reserve(self, first, last):
+        """Make room for the days from first to last (dates)."""
+        if self.origin is None:
+            self.origin = first
+        before = max(0, (self.origin - first).days)
+        days = max(self.days, (last - self.origin).days + 1) + before
+        capacity = len(self._columns[HOURLY_FIELDS[0]]) // HOURS
+        if before or days > capacity:
+            # Doubled when growing forward, so appending days is amortized O(1)
+            capacity = days if before else max(days, 2 * capacity)
+            for field, column in self._columns.items():
+                grown = np.full(capacity * HOURS, np.nan)
+                grown[before * HOURS:(before + self.days) * HOURS] = column[:self.days * HOURS]
+                self._columns[field] = grown
+            self.origin -= timedelta(days=before)
+        self.days = days
+
+    def add(self, day, data):
+        """Set the hours of a day (date) from {field: [24 values]}."""
+        self._reserve(day, day)
+        start = (day - self.origin).days * HOURS
+        for field, column in self._columns.items():
+            values = data.get(field)
+            column[start:start + HOURS] = np.nan if values is None else np.array(values, dtype=float)
+
+    def load(self, store):
+        """Fill the columns from the hourly days of a consumption store."""
+        oldest, latest = store.oldest(KIND_HOURLY), store.latest(KIND_HOURLY)
+        if oldest is None:
+            return
+        days = store.range(KIND_HOURLY, oldest[0], latest[0])
+        self._reserve(day_from_string(oldest[0]), day_from_string(latest[0]))
+        for day, data in days:
+            self.add(day_from_string(day), data)
+        _LOGGER.debug("Loaded %s days of hourly consumption", len(days))
+
+    def matrix(self, field, start, end):
+        """Return (first day, (days, 24) view) of a field from start to end (dates), (None, None) if empty."""
+        if self.origin is None:
+            return None, None
+        first = max(0, (start - self.origin).days)
+        last = min(self.days - 1, (end - self.origin).days)
+        if last < first:
+            return None, None
+        column = self._columns[field][first * HOURS:(last + 1) * HOURS]
+        return self.origin + timedelta(days=first), column.reshape(-1, HOURS)
+
+
+def daily_totals(matrix):
+    """Return the sum of each row, NaN for the rows without data."""
+    counts = np.count_nonzero(~np.isnan(matrix), axis=1)
+    totals = np.nansum(matrix, axis=1)
+    totals[counts == 0] = np.nan
+    return totals
+
+
+def rolling_mean(values, window):
+    """Return the mean of each window of values ending at each value, ignoring NaN."""
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    window = max(1, window)
+    # Windows are shorter at the start of the data
+    lower = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+    upper = np.arange(1, len(values) + 1)
+    count = counts[upper] - counts[lower]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, (sums[upper] - sums[lower]) / count, np.nan)
+
+
+def peak_hours(matrix):
+    """Return (hour, value) arrays of the maximum of each row, -1 and NaN for the rows without data."""
+    filled = np.where(np.isnan(matrix), -np.inf, matrix)
+    hours = filled.argmax(axis=1)
+    values = filled[np.arange(len(filled)), hours]
+    empty = np.isneginf(values)
+    hours[empty] = -1
+    values[empty] = np.nan
+    return hours, values
+
+
+def regression(x, y):
+    """Return (slope, intercept, r²) of the least squares line of y by x, None if undetermined."""
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    if len(x) < 2 or not np.ptp(x):
+        return None
+    slope, intercept = np.polyfit(x, y, 1)
+    spread = np.sum((y - y.mean()) ** 2)
+    r_squared = 1 - np.sum((y - (slope * x + intercept)) ** 2) / spread if spread else 1.0
+    return float(slope), float(intercept), float(r_squared)
+
+
+def percentiles(values, shares):
+    """Return {share: value} of the percentiles (0..100) of values, ignoring NaN."""
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {share: None for share in shares}
+    return dict(zip(shares, (float(value) for value in np.percentile(values, shares))))
+
+
+def _round(value, digits=2):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def analyze(columns, start, end, rolling_days=DEFAULT_ROLLING_DAYS, shares=DEFAULT_PERCENTILES):
+    """Return the aggregates of the hourly data from start to end (dates), None without data."""
+    first, consumption = columns.matrix("total_consumption", start, end)
+    if first is None:
+        return None
+    _, temperature = columns.matrix("average_temperature", start, end)
+
+    totals = daily_totals(consumption)
+    rolling = rolling_mean(totals, rolling_days)
+    hours, peaks = peak_hours(consumption)
+    line = regression(temperature.ravel(), consumption.ravel())
+    hourly = percentiles(consumption.ravel(), shares)
+
+    days = np.flatnonzero(~np.isnan(totals))
+    return {
+        "start": first.isoformat(),
+        "end": (first + timedelta(days=len(totals) - 1)).isoformat(),
+        "days": len(days),
+        "total_consumption": _round(np.nansum(totals)),
+        "daily": [
+            {
+                "date": (first + timedelta(days=int(index))).isoformat(),
+                "total_consumption": _round(totals[index]),
+                "rolling_mean": _round(rolling[index]),
+                "peak_hour": int(hours[index]),
+                "peak_consumption": _round(peaks[index]),
+            }
+            for index in days
+        ],
+        "temperature_regression": None if line is None else {
+            "slope": _round(line[0], 3),
+            "intercept": _round(line[1], 3),
+            "r_squared": _round(line[2], 3),
+        },
+        "percentiles": {str(share): _round(value) for share, value in hourly.items()},
+    }
+
+
+def summarize(columns, days=SUMMARY_DAYS):
+    """Return the aggregates shown by the sensors: last day of the last days of data, None without data."""
+    end = columns.last_day
+    if end is None:
+        return None
+    analysis = analyze(columns, end - timedelta(days=days - 1), end, shares=(95,))
+    if analysis is None or not analysis["daily"]:
+        return None
+    last = analysis["daily"][-1]
+    line = analysis["temperature_regression"] or {}
+    return {
+        "date": last["date"],
+        "rolling_mean": last["rolling_mean"],
+        "peak_hour": last["peak_hour"],
+        "peak_consumption": last["peak_consumption"],
+        "temperature_slope": line.get("slope"),
+        "r_squared": line.get("r_squared"),
+        "hourly_p95": analysis["percentiles"]["95"],
+    }
@@ -0,0 +1,289 @@
+"""Local consumption history of HydroQuebec contracts and its synchronization."""
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+import json
+import logging
+
+from pyhydroquebec.consts import HOURLY_DATA_URL_1, HOURLY_DATA_URL_2
+
+_LOGGER = logging.getLogger(__name__)
+
+KIND_DAILY = "daily"
+KIND_HOURLY = "hourly"
+KIND_META = "meta"
+
+# History requested on the first synchronization
+BACKFILL_DAYS = 730
+# Days per daily data request
+MAX_RANGE_DAYS = 366
+# Daily requests per synchronization, when filling holes
+MAX_DAILY_REQUESTS = 10
+# Hourly data is fetched one day per request, newest days first: a year in 6 updates
+HOURLY_BACKFILL_DAYS = 365
+MAX_HOURLY_DAYS = 62
+
+HOURLY_FIELDS = (
+    "total_consumption",
+    "lower_price_consumption",
+    "higher_price_consumption",
+    "average_temperature",
+)
+# Raw names of the portal, fetched directly on the 25 hours days pyhydroquebec fails on
+RAW_HOURLY_FIELDS = {
+    "total_consumption": "consoTotal",
+    "lower_price_consumption": "consoReg",
+    "higher_price_consumption": "consoHaut",
+}
+
+# Daylight saving time: 2:00 is skipped in spring, 1:00 repeated in fall
+DST_SKIPPED_HOUR = 2
+DST_REPEATED_HOUR = 1
+
+# Days still possibly published later: a missing one is requested again at the next update
+RECENT_DAYS = 3
+
+
+def day_from_string(day):
+    """Return the date of a YYYY-MM-DD string."""
+    return datetime.strptime(day, "%Y-%m-%d").date()
+
+
+def _days(start, end):
+    """Yield the dates from start to end (inclusive)."""
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+class HydroQuebecConsumptionStore:
+    """Append-only store of the daily and hourly consumption of a contract, one JSON line per day
+
+    The whole history is kept in memory once loaded: years of days are served in
+    milliseconds. A later line for the same day replaces the previous one.
+    Blocking methods, run them in the executor.
+    """
+
+    def __init__(self, path):
+        """Initialize the store at path."""
+        self._path = path
+        self._data = {KIND_DAILY: {}, KIND_HOURLY: {}}
+        self._dates = {KIND_DAILY: [], KIND_HOURLY: []}
+        self.first_day = None
+
+    def load(self):
+        """Read the store."""
+        try:
+            with open(self._path, "r") as store:
+                for line in store:
+                    if line.endswith("\n"):
+                        self._add(json.loads(line))
+        except FileNotFoundError:
+            pass
+
+    def _add(self, record):
+        kind = record["kind"]
+        if kind == KIND_META:
+            self.first_day = record.get("first_day", self.first_day)
+            return
+        day = record["date"]
+        if day not in self._data[kind]:
+            insort(self._dates[kind], day)
+        self._data[kind][day] = record["data"]
+
+    def append(self, records):
+        """Append records: dicts of kind, date (YYYY-MM-DD) and data, or meta."""
+        if not records:
+            return
+        with open(self._path, "a") as store:
+            for record in records:
+                store.write(json.dumps(record, separators=(",", ":")) + "\n")
+        for record in records:
+            self._add(record)
+
+    def get(self, kind, day):
+        """Return the data of a day (YYYY-MM-DD), None if missing."""
+        return self._data[kind].get(day)
+
+    def has(self, kind, day):
+        """Return True if the day is stored."""
+        return day in self._data[kind]
+
+    def oldest(self, kind):
+        """Return (date, data) of the first stored day, or None."""
+        if not self._dates[kind]:
+            return None
+        day = self._dates[kind][0]
+        return day, self._data[kind][day]
+
+    def latest(self, kind):
+        """Return (date, data) of the last stored day, or None."""
+        if not self._dates[kind]:
+            return None
+        day = self._dates[kind][-1]
+        return day, self._data[kind][day]
+
+    def range(self, kind, start, end):
+        """Return [(date, data)] of the stored days from start to end (YYYY-MM-DD, inclusive)."""
+        dates = self._dates[kind]
+        return [
+            (day, self._data[kind][day])
+            for day in dates[bisect_left(dates, start):bisect_right(dates, end)]
+        ]
+
+    def missing(self, kind, start, end):
+        """Return the dates from start to end (date objects) not stored."""
+        return [day for day in _days(start, end) if day.isoformat() not in self._data[kind]]
+
+
+def _merge(first, second, mean):
+    """Return the value of two hourly values of the same hour: their mean or sum, ignoring None."""
+    values = [value for value in (first, second) if value is not None]
+    if not values:
+        return None
+    return sum(values) / len(values) if mean else sum(values)
+
+
+def day_hours(values, mean=False):
+    """Return the 24 local hours of the hourly values of a day, 23 to 25 long with the DST changes.
+
+    The hour skipped in spring is None, the two hours repeated in fall are summed
+    (averaged if mean). A field the portal did not return is None all day.
+    """
+    values = list(values)
+    if not values:
+        return [None] * 24
+    if len(values) == 23:
+        return values[:DST_SKIPPED_HOUR] + [None] + values[DST_SKIPPED_HOUR:]
+    if len(values) == 25:
+        merged = _merge(values[DST_REPEATED_HOUR], values[DST_REPEATED_HOUR + 1], mean)
+        return values[:DST_REPEATED_HOUR] + [merged] + values[DST_REPEATED_HOUR + 2:]
+    if len(values) != 24:
+        raise ValueError(f"{len(values)} hours in a day")
+    return values
+
+
+def _ranges(days, max_days):
+    """Group sorted dates into (start, end) ranges of consecutive days, max_days long at most."""
+    ranges = []
+    for day in days:
+        if ranges and day - ranges[-1][1] == timedelta(days=1) and (day - ranges[-1][0]).days < max_days:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(item) for item in ranges]
+
+
+class HydroQuebecSync:
+    """Fill the store of a contract with what the portal has and the store misses"""
+
+    def __init__(self, hass, store, columns=None):
+        """Initialize the synchronization of a store, also feeding the new hourly days to columns."""
+        self._hass = hass
+        self.store = store
+        self.columns = columns
+        # Days without daily or hourly data on the portal, not requested again until restarted
+        self._no_daily = set()
+        self._no_hourly = set()
+
+    async def async_sync(self, customer, today):
+        """Fetch the missing daily then hourly data up to yesterday. Returns the number of new days."""
+        yesterday = today - timedelta(days=1)
+        added = await self._async_sync_daily(customer, yesterday)
+        added += await self._async_sync_hourly(customer, yesterday)
+        return added
+
+    async def _async_sync_daily(self, customer, yesterday):
+        store = self.store
+        backfill = store.first_day is None
+        start = (day_from_string(store.first_day) if not backfill
+                 else yesterday - timedelta(days=BACKFILL_DAYS))
+        missing = [day for day in store.missing(KIND_DAILY, start, yesterday) if day not in self._no_daily]
+        ranges = _ranges(missing, MAX_RANGE_DAYS)
+        # Newest first: the current days matter more than the holes of the past
+        ranges = ranges[::-1][:MAX_DAILY_REQUESTS]
+
+        added = 0
+        for first, last in ranges:
+            _LOGGER.debug("Fetching HydroQuebec daily data from %s to %s", first, last)
+            await customer.fetch_daily_data(first.isoformat(), last.isoformat())
+            records = []
+            for day in _days(first, last):
+                data = customer.current_daily_data.get(day.isoformat())
+                if data is not None:
+                    records.append({"kind": KIND_DAILY, "date": day.isoformat(), "data": data})
+                elif day <= yesterday - timedelta(days=RECENT_DAYS):
+                    # Hole of the portal, not worth a request at each update
+                    self._no_daily.add(day)
+            # Stored range by range, an interrupted backfill resumes where it stopped
+            await self._hass.async_add_executor_job(store.append, records)
+            added += len(records)
+
+        if backfill and added:
+            # Days before the first one available are not requested again
+            first_day = store.oldest(KIND_DAILY)[0]
+            await self._hass.async_add_executor_job(
+                store.append, [{"kind": KIND_META, "first_day": first_day}]
+            )
+        return added
+
+    async def _async_sync_hourly(self, customer, yesterday):
+        store = self.store
+        start = yesterday - timedelta(days=HOURLY_BACKFILL_DAYS)
+        # Hourly data exists for the days with daily data only
+        days = [
+            day for day in reversed(store.missing(KIND_HOURLY, start, yesterday))
+            if store.has(KIND_DAILY, day.isoformat()) and day not in self._no_hourly
+        ][:MAX_HOURLY_DAYS]
+
+        added = 0
+        for day in days:
+            day_str = day.isoformat()
+            try:
+                hourly = await self._async_fetch_hourly(customer, day_str)
+                data = {
+                    field: day_hours(values, mean=field == "average_temperature")
+                    for field, values in hourly.items()
+                }
+            except (IndexError, KeyError, TypeError, ValueError) as exception_:
+                # pyhydroquebec fails on the days the portal has no hourly data for
+                _LOGGER.debug("No HydroQuebec hourly data for %s: %r", day_str, exception_)
+                if day <= yesterday - timedelta(days=RECENT_DAYS):
+                    self._no_hourly.add(day)
+                continue
+            # Stored day by day, the days fetched before a failure are not fetched again
+            await self._hass.async_add_executor_job(
+                store.append, [{"kind": KIND_HOURLY, "date": day_str, "data": data}]
+            )
+            if self.columns is not None:
+                self.columns.add(day, data)
+            added += 1
+        return added
+
+    @staticmethod
+    async def _async_fetch_hourly(customer, day_str):
+        """Return {field: [values of the hours of the day as returned]}, 23 to 25 hours."""
+        try:
+            await customer.fetch_hourly_data(day_str)
+        except KeyError:
+            # pyhydroquebec only knows 24 hours days: read the 25 hours of the fall DST change here
+            return await HydroQuebecSync._async_fetch_hourly_raw(customer, day_str)
+        hours = customer.hourly_data[day_str]["hours"]
+        # pyhydroquebec leaves the hours missing on a 23 hours day empty
+        return {
+            field: [hours[hour][field] for hour in sorted(hours) if field in hours[hour]]
+            for field in HOURLY_FIELDS
+        }
+
+    @staticmethod
+    async def _async_fetch_hourly_raw(customer, day_str):
+        """Return {field: [values]} of a day read from the portal responses, all their hours."""
+        # pylint: disable=protected-access
+        client = customer._client
+        res = await client.http_request(HOURLY_DATA_URL_2, "get", params={"dateDebut": day_str, "dateFin": day_str})
+        temperatures = json.loads(await res.text())["results"][0]["listeTemperaturesHeure"]
+        res = await client.http_request(HOURLY_DATA_URL_1, "get", params={"date": day_str})
+        rows = json.loads(await res.text())["results"]["listeDonneesConsoEnergieHoraire"]
+        data = {field: [row[name] for row in rows] for field, name in RAW_HOURLY_FIELDS.items()}
+        data["average_temperature"] = temperatures
+        return data
@@ -12,6 +12,7 @@ import asyncio
 from datetime import datetime, timedelta
 from dateutil import tz
 
+import aiohttp
 import voluptuous as vol
 
 from homeassistant.components.sensor import PLATFORM_SCHEMA
@@ -23,23 +24,63 @@ from homeassistant.const import (
     CONF_MONITORED_VARIABLES,
     TEMP_CELSIUS,
 )
+from homeassistant.core import callback
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
 from homeassistant.helpers.entity import Entity
 from homeassistant.util import Throttle
 import homeassistant.helpers.config_validation as cv
 
-from pyhydroquebec.error import PyHydroQuebecHTTPError
+from pyhydroquebec.error import PyHydroQuebecError, PyHydroQuebecHTTPError
 from pyhydroquebec.client import HydroQuebecClient
 
+from .analytics import (
+    DEFAULT_PERCENTILES,
+    DEFAULT_ROLLING_DAYS,
+    HydroQuebecHourlyColumns,
+    analyze,
+    summarize,
+)
+from .consumption import KIND_DAILY, HydroQuebecConsumptionStore, HydroQuebecSync
+from .session import HydroQuebecSession, detach_customer
+from .tariffs import RATE_D, RATES, cost_report, summarize_costs
+
 _LOGGER = logging.getLogger(__name__)
 
+DOMAIN = "hydroquebec"
+# username -> (client, session, semaphore) shared by the platforms of an account
+DATA_ACCOUNTS = "hydroquebec_accounts"
+
 KILOWATT_HOUR = ENERGY_KILO_WATT_HOUR
 PRICE = "CAD"
 DAYS = "days"
 CONF_CONTRACT = "contract"
+CONF_CONTRACTS = "contracts"
+CONF_RATE = "rate"
+CONF_PEAK_EVENTS = "peak_events"
+
+ATTR_CONTRACT = "contract"
+ATTR_DATE = "date"
+ATTR_START = "start"
+ATTR_END = "end"
+ATTR_ROLLING_DAYS = "rolling_days"
+ATTR_PERCENTILES = "percentiles"
+ATTR_RATE = "rate"
+ATTR_PEAK_EVENTS = "peak_events"
+ATTR_PEAK_START = "start"
+ATTR_PEAK_END = "end"
+
+SERVICE_QUERY_CONSUMPTION = "query_consumption"
+EVENT_CONSUMPTION = "hydroquebec_consumption"
+SERVICE_ANALYZE_CONSUMPTION = "analyze_consumption"
+EVENT_CONSUMPTION_ANALYSIS = "hydroquebec_consumption_analysis"
+SERVICE_ESTIMATE_COST = "estimate_cost"
+EVENT_COST = "hydroquebec_cost"
 
 DEFAULT_NAME = "HydroQuebec"
 
 REQUESTS_TIMEOUT = 15
+# Contracts of an account fetched at the same time
+MAX_CONCURRENT_CONTRACTS = 3
 MIN_TIME_BETWEEN_UPDATES = timedelta(hours=6)
 SCAN_INTERVAL = timedelta(hours=6)
 
@@ -70,18 +111,110 @@ SENSOR_TYPES = {
     ],
 }
 
+# Computed from the hourly history, over its last year
+ANALYTICS_SENSOR_TYPES = {
+    "rolling_mean_consumption": [
+        f"{DEFAULT_ROLLING_DAYS} days mean consumption",
+        KILOWATT_HOUR,
+        "mdi:chart-line",
+        "rolling_mean",
+    ],
+    "peak_hour": [
+        "Peak hour",
+        "h",
+        "mdi:clock-outline",
+        "peak_hour",
+    ],
+    "temperature_sensitivity": [
+        "Consumption per degree",
+        f"{KILOWATT_HOUR}/{TEMP_CELSIUS}",
+        "mdi:thermometer-lines",
+        "temperature_slope",
+    ],
+    "hourly_consumption_p95": [
+        "Hourly consumption 95th percentile",
+        KILOWATT_HOUR,
+        "mdi:flash",
+        "hourly_p95",
+    ],
+}
+
+# Costs under the configured rate, taxes excluded
+COST_SENSOR_TYPES = {
+    "last_day_cost": [
+        "Last day cost",
+        PRICE,
+        "mdi:cash",
+        "day_cost",
+    ],
+    "month_cost": [
+        "Month cost",
+        PRICE,
+        "mdi:cash-multiple",
+        "month_cost",
+    ],
+}
+
+# Flex D peak events announced by HydroQuebec, local times
+PEAK_EVENTS_SCHEMA = vol.All(
+    cv.ensure_list,
+    [
+        vol.Schema(
+            {
+                vol.Required(ATTR_PEAK_START): cv.datetime,
+                vol.Required(ATTR_PEAK_END): cv.datetime,
+            }
+        )
+    ],
+)
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_MONITORED_VARIABLES): vol.All(
-            cv.ensure_list, [vol.In(SENSOR_TYPES)]
+            cv.ensure_list,
+            [vol.In({**SENSOR_TYPES, **ANALYTICS_SENSOR_TYPES, **COST_SENSOR_TYPES})],
         ),
         vol.Required(CONF_USERNAME): cv.string,
         vol.Required(CONF_PASSWORD): cv.string,
-        vol.Required(CONF_CONTRACT): cv.string,
+        vol.Exclusive(CONF_CONTRACT, CONF_CONTRACTS): cv.string,
+        vol.Exclusive(CONF_CONTRACTS, CONF_CONTRACTS): vol.All(cv.ensure_list, [cv.string]),
         vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+        vol.Optional(CONF_RATE, default=RATE_D): vol.In(RATES),
+        vol.Optional(CONF_PEAK_EVENTS, default=[]): PEAK_EVENTS_SCHEMA,
+    }
+)
+
+QUERY_CONSUMPTION_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_CONTRACT): cv.string,
+        vol.Required(ATTR_START): cv.date,
+        vol.Required(ATTR_END): cv.date,
+    }
+)
+
+ANALYZE_CONSUMPTION_SCHEMA = QUERY_CONSUMPTION_SCHEMA.extend(
+    {
+        vol.Optional(ATTR_ROLLING_DAYS, default=DEFAULT_ROLLING_DAYS): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional(ATTR_PERCENTILES, default=list(DEFAULT_PERCENTILES)): vol.All(
+            cv.ensure_list, [vol.All(vol.Coerce(float), vol.Range(min=0, max=100))]
+        ),
     }
 )
 
+ESTIMATE_COST_SCHEMA = QUERY_CONSUMPTION_SCHEMA.extend(
+    {
+        vol.Optional(ATTR_RATE): vol.In(RATES),
+        vol.Optional(ATTR_PEAK_EVENTS): PEAK_EVENTS_SCHEMA,
+    }
+)
+
+
+def _peak_events(events):
+    """Return the [(start, end)] of validated peak events."""
+    return [(event[ATTR_PEAK_START], event[ATTR_PEAK_END]) for event in events]
+
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the HydroQuebec sensor."""
@@ -90,18 +223,122 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
 
     username = config.get(CONF_USERNAME)
     password = config.get(CONF_PASSWORD)
-    contract = config.get(CONF_CONTRACT)
+    contracts = config.get(CONF_CONTRACTS)
+    if CONF_CONTRACT in config:
+        contracts = [config[CONF_CONTRACT]]
     name = config.get(CONF_NAME)
     time_zone = str(hass.config.time_zone)
 
     httpsession = hass.helpers.aiohttp_client.async_get_clientsession()
-    hydroquebec_data = HydroquebecData(username, password, httpsession, contract, time_zone)
-
-    await hydroquebec_data.async_update()
+    hydroquebec_data = HydroquebecData(
+        hass, username, password, httpsession, contracts, time_zone,
+        RATES[config[CONF_RATE]], _peak_events(config[CONF_PEAK_EVENTS]),
+    )
+
+    # Logs in and loads the local history only: the first synchronization backfills
+    # years of history, too long for the platform setup
+    await hydroquebec_data.async_setup()
+    hass.async_create_task(hydroquebec_data.async_update())
+
+    hass.data.setdefault(DOMAIN, []).append(hydroquebec_data)
+
+    async def async_query_consumption(call):
+        """Fire an event with the stored daily consumption of a period."""
+        start = call.data[ATTR_START].isoformat()
+        end = call.data[ATTR_END].isoformat()
+        for data in hass.data[DOMAIN]:
+            for contract, store in data.stores.items():
+                if call.data.get(ATTR_CONTRACT) not in (None, contract):
+                    continue
+                days = store.range(KIND_DAILY, start, end)
+                hass.bus.async_fire(EVENT_CONSUMPTION, {
+                    ATTR_CONTRACT: contract,
+                    ATTR_START: start,
+                    ATTR_END: end,
+                    "total_consumption": round(
+                        sum(values["total_consumption"] or 0 for _, values in days), 2
+                    ),
+                    "days": [dict(values, date=day) for day, values in days],
+                })
+
+    if not hass.services.has_service(DOMAIN, SERVICE_QUERY_CONSUMPTION):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_QUERY_CONSUMPTION,
+            async_query_consumption,
+            schema=QUERY_CONSUMPTION_SCHEMA,
+        )
+
+    async def async_analyze_consumption(call):
+        """Fire an event with the aggregates of the stored hourly consumption of a period."""
+        for data in hass.data[DOMAIN]:
+            for contract, columns in data.columns.items():
+                if call.data.get(ATTR_CONTRACT) not in (None, contract):
+                    continue
+                analysis = await hass.async_add_executor_job(
+                    analyze,
+                    columns,
+                    call.data[ATTR_START],
+                    call.data[ATTR_END],
+                    call.data[ATTR_ROLLING_DAYS],
+                    call.data[ATTR_PERCENTILES],
+                )
+                hass.bus.async_fire(EVENT_CONSUMPTION_ANALYSIS, dict(
+                    analysis or {},
+                    contract=contract,
+                    start=call.data[ATTR_START].isoformat(),
+                    end=call.data[ATTR_END].isoformat(),
+                ))
+
+    if not hass.services.has_service(DOMAIN, SERVICE_ANALYZE_CONSUMPTION):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_ANALYZE_CONSUMPTION,
+            async_analyze_consumption,
+            schema=ANALYZE_CONSUMPTION_SCHEMA,
+        )
+
+    async def async_estimate_cost(call):
+        """Fire an event with the costs of the stored hourly consumption of a period."""
+        for data in hass.data[DOMAIN]:
+            rate = RATES[call.data[ATTR_RATE]] if ATTR_RATE in call.data else data.rate
+            peak_events = (_peak_events(call.data[ATTR_PEAK_EVENTS])
+                           if ATTR_PEAK_EVENTS in call.data else data.peak_events)
+            for contract, columns in data.columns.items():
+                if call.data.get(ATTR_CONTRACT) not in (None, contract):
+                    continue
+                report = await hass.async_add_executor_job(
+                    cost_report, columns, rate, call.data[ATTR_START], call.data[ATTR_END], peak_events,
+                    data.rate,
+                )
+                hass.bus.async_fire(EVENT_COST, dict(
+                    report or {},
+                    contract=contract,
+                    start=call.data[ATTR_START].isoformat(),
+                    end=call.data[ATTR_END].isoformat(),
+                ))
+
+    if not hass.services.has_service(DOMAIN, SERVICE_ESTIMATE_COST):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_ESTIMATE_COST,
+            async_estimate_cost,
+            schema=ESTIMATE_COST_SCHEMA,
+        )
 
     sensors = []
-    for variable in config[CONF_MONITORED_VARIABLES]:
-        sensors.append(HydroQuebecSensor(hydroquebec_data, variable, name))
+    contracts = hydroquebec_data.contracts
+    for contract in contracts:
+        # The names of a single contract sensors do not change
+        client_name = name if len(contracts) == 1 else f"{name} {contract}"
+        for variable in config[CONF_MONITORED_VARIABLES]:
+            if variable in COST_SENSOR_TYPES:
+                sensor_class = HydroQuebecCostSensor
+            elif variable in ANALYTICS_SENSOR_TYPES:
+                sensor_class = HydroQuebecAnalyticsSensor
+            else:
+                sensor_class = HydroQuebecSensor
+            sensors.append(sensor_class(hydroquebec_data, variable, client_name, contract))
 
     async_add_entities(sensors, True)
 
@@ -111,15 +348,19 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
 class HydroQuebecSensor(Entity):
     """Implementation of a HydroQuebec sensor."""
 
-    def __init__(self, hydroquebec_data, sensor_type, name):
+    sensor_types = SENSOR_TYPES
+
+    def __init__(self, hydroquebec_data, sensor_type, name, contract=None):
         """Initialize the sensor."""
         self.type = sensor_type
+        self._contract = contract
         self._client_name = name
-        self._name = SENSOR_TYPES[sensor_type][0]
-        self._unit_of_measurement = SENSOR_TYPES[sensor_type][1]
-        self._icon = SENSOR_TYPES[sensor_type][2]
+        self._name = self.sensor_types[sensor_type][0]
+        self._unit_of_measurement = self.sensor_types[sensor_type][1]
+        self._icon = self.sensor_types[sensor_type][2]
         self._hydroquebec_data = hydroquebec_data
         self._state = None
+        self._date = None
 
     @property
     def name(self):
@@ -141,32 +382,125 @@ class HydroQuebecSensor(Entity):
         """Icon to use in the frontend, if any."""
         return self._icon
 
+    @property
+    def device_state_attributes(self):
+        """Return the day of the consumption."""
+        return {ATTR_DATE: self._date}
+
+    async def async_added_to_hass(self):
+        """Follow the synchronizations run in the background."""
+        self._hydroquebec_data.async_add_listener(self._async_handle_update)
+
+    @callback
+    def _async_handle_update(self):
+        """Handle new data synchronized by the data object."""
+        self.async_schedule_update_ha_state(True)
+
     async def async_update(self):
         """Get the latest data from Hydroquebec and update the state."""
         await self._hydroquebec_data.async_update()
 
-        curr = self._hydroquebec_data.get_data().current_daily_data
-        yesterday_date = list(curr.keys())[0]
-        val = curr[yesterday_date][SENSOR_TYPES[self.type][3]]
+        latest = self._hydroquebec_data.latest_daily(self._contract)
+        if latest is None:
+            self._state = None
+            return
+        self._date, values = latest
+        val = values[SENSOR_TYPES[self.type][3]]
         if val is not None:
             self._state = round(val, 2)
         else:
             self._state = None
 
 
+class HydroQuebecAnalyticsSensor(HydroQuebecSensor):
+    """HydroQuebec sensor computed from the hourly history."""
+
+    sensor_types = ANALYTICS_SENSOR_TYPES
+
+    async def async_update(self):
+        """Get the latest aggregates of the hourly history."""
+        await self._hydroquebec_data.async_update()
+
+        summary = self._latest()
+        if summary is None:
+            self._state = self._date = None
+            return
+        self._date = summary["date"]
+        self._state = summary[self.sensor_types[self.type][3]]
+
+    def _latest(self):
+        return self._hydroquebec_data.latest_summary(self._contract)
+
+
+class HydroQuebecCostSensor(HydroQuebecAnalyticsSensor):
+    """HydroQuebec cost sensor, under the configured rate."""
+
+    sensor_types = COST_SENSOR_TYPES
+
+    @property
+    def device_state_attributes(self):
+        """Return the day of the cost and the rate."""
+        return {ATTR_DATE: self._date, ATTR_RATE: self._hydroquebec_data.rate.name}
+
+    def _latest(self):
+        return self._hydroquebec_data.latest_costs(self._contract)
+
+
 class HydroquebecData:
     """Get data from HydroQuebec."""
 
-    def __init__(self, username, password, httpsession, contract=None, time_zone='America/Montreal'):
+    def __init__(self, hass, username, password, httpsession, contracts=None, time_zone='America/Montreal',
+                 rate=RATES[RATE_D], peak_events=()):
         """Initialize the data object."""
 
-        self._client = HydroQuebecClient(
-            username, password, REQUESTS_TIMEOUT, httpsession #, 'DEBUG'
-         )
-
+        accounts = hass.data.setdefault(DATA_ACCOUNTS, {})
+        if username not in accounts:
+            client = HydroQuebecClient(
+                username, password, REQUESTS_TIMEOUT, httpsession #, 'DEBUG'
+             )
+            # Logs in only when the cached session expired or is refused
+            accounts[username] = (
+                client,
+                HydroQuebecSession(hass, client, username),
+                asyncio.Semaphore(MAX_CONCURRENT_CONTRACTS),
+            )
+        self._client, self._session, self._semaphore = accounts[username]
+
+        self._hass = hass
         self._tz = tz.gettz(time_zone)
-        self._contract = contract
+        self._contracts = contracts
+        # contract -> customer of the last fetch
         self._data = {}
+        # contract -> local consumption history
+        self.stores = {}
+        # contract -> hourly history, by field
+        self.columns = {}
+        self._syncs = {}
+        self._summaries = {}
+        self.rate = rate
+        self.peak_events = peak_events
+        self._costs = {}
+        self._listeners = []
+
+
+    async def async_setup(self):
+        """Log in and load the local history of the contracts, without fetching them."""
+        try:
+            customers = await self._session.async_call(self._async_customers)
+        except PyHydroQuebecError as exception_:
+            _LOGGER.error("Unable to log in HydroQuebec: %s", exception_)
+            return
+        for customer in customers:
+            contract = customer.contract_id
+            await self._async_get_sync(contract)
+            await self._async_summarize(contract)
+            self._data[contract] = customer
+
+
+    @callback
+    def async_add_listener(self, update_callback):
+        """Call update_callback after each synchronization."""
+        self._listeners.append(update_callback)
 
 
     @Throttle(MIN_TIME_BETWEEN_UPDATES)
@@ -175,27 +509,117 @@ class HydroquebecData:
 
         _LOGGER.debug("Updating HQ sensor")
 
-        await self._client.login()
+        try:
+            await self._session.async_call(self._async_fetch)
+        except PyHydroQuebecError as exception_:
+            _LOGGER.error("Unable to fetch HydroQuebec data: %s", exception_)
+
+        for update_callback in self._listeners:
+            update_callback()
+
+
+    async def _async_customers(self):
+        """Return the customers of the configured contracts, the first available if none."""
+        customers = self._client.customers
+        if self._contracts is None:
+            _LOGGER.warning("Contract id not specified, using first available.")
+            return customers[:1]
+        customers = [customer for customer in customers if customer.contract_id in self._contracts]
+        missing = set(self._contracts) - {customer.contract_id for customer in customers}
+        if missing:
+            _LOGGER.error("HydroQuebec contracts not found: %s", ", ".join(sorted(missing)))
+        return customers
+
+
+    async def _async_fetch(self):
+        """Fetch the days missing in the local history of the contracts, concurrently."""
+        customers = await self._async_customers()
+        results = await asyncio.gather(
+            *(self._async_fetch_contract(customer) for customer in customers), return_exceptions=True
+        )
+        for customer, result in zip(customers, results):
+            # A refused session fails all the contracts: log in again and fetch them again
+            if isinstance(result, PyHydroQuebecHTTPError):
+                raise result
+            if isinstance(result, Exception):
+                _LOGGER.error("Unable to fetch HydroQuebec contract %s: %s", customer.contract_id, result)
+
+
+    async def _async_fetch_contract(self, customer):
+        """Fetch the days missing in the local history of a contract."""
+        contract = customer.contract_id
+        async with self._semaphore:
+            # Each contract selects itself in its own session of the portal. The shared
+            # session cookie jar would mix the sessions: the client cookies only are sent
+            httpsession = async_create_clientsession(
+                self._hass, auto_cleanup=False, cookie_jar=aiohttp.DummyCookieJar()
+            )
+            try:
+                detached = detach_customer(self._client, customer, httpsession)
+                # Close to midnight, yesterday is not available yet: it stays missing until the next update
+                sync = await self._async_get_sync(contract)
+                added = await sync.async_sync(detached, datetime.now(self._tz).date())
+            finally:
+                await httpsession.close()
+            _LOGGER.debug("Stored %s new HydroQuebec days for contract %s", added, contract)
+            await self._async_summarize(contract)
+
+            self._data[contract] = customer
+
+
+    async def _async_summarize(self, contract):
+        """Compute the aggregates and costs shown by the sensors of a contract."""
+        self._summaries[contract] = await self._hass.async_add_executor_job(
+            summarize, self.columns[contract]
+        )
+        self._costs[contract] = await self._hass.async_add_executor_job(
+            summarize_costs, self.columns[contract], self.rate, self.peak_events
+        )
+
+
+    async def _async_get_sync(self, contract):
+        """Return the synchronization of a contract, loading its history the first time."""
+        sync = self._syncs.get(contract)
+        if sync is None:
+            store = HydroQuebecConsumptionStore(
+                self._hass.config.path(".storage", f"hydroquebec.{contract}.consumption")
+            )
+            columns = HydroQuebecHourlyColumns()
+            await self._hass.async_add_executor_job(store.load)
+            await self._hass.async_add_executor_job(columns.load, store)
+            self.stores[contract] = store
+            self.columns[contract] = columns
+            sync = self._syncs[contract] = HydroQuebecSync(self._hass, store, columns)
+        return sync
+
 
-        for customer in self._client.customers:
-            if customer.contract_id != self._contract and self._contract is not None:
-                continue
-            if self._contract is None:
-                _LOGGER.warning("Contract id not specified, using first available.")
+    @property
+    def contracts(self):
+        """Return the contracts of the sensors: the configured ones, else the first available."""
+        if self._contracts is not None:
+            return self._contracts
+        return list(self._data)[:1] or [None]
 
-            yesterday = datetime.now(self._tz) - timedelta(days=1)
-            yesterday_str = yesterday.strftime("%Y-%m-%d")
-            await customer.fetch_daily_data(yesterday_str, yesterday_str)
 
-            # Close to midnight, yesterday not yet available. Get the day before then.
-            if not customer.current_daily_data:
-                yesterday = yesterday - timedelta(days=1)
-                yesterday_str = yesterday.strftime("%Y-%m-%d")
-                await customer.fetch_daily_data(yesterday_str, yesterday_str)
+    def _contract(self, contract):
+        """Return the contract, the first available if None."""
+        return contract if contract is not None else next(iter(self._data), None)
 
-            self._data = customer
 
-            return
+    def latest_daily(self, contract=None):
+        """Return (date, data) of the last day stored for the contract, or None."""
+        store = self.stores.get(self._contract(contract))
+        return None if store is None else store.latest(KIND_DAILY)
+
+
+    def latest_summary(self, contract=None):
+        """Return the aggregates of the last year of hourly data of the contract, or None."""
+        return self._summaries.get(self._contract(contract))
+
+
+    def latest_costs(self, contract=None):
+        """Return the costs of the last day of hourly data of the contract and its month, or None."""
+        return self._costs.get(self._contract(contract))
 
 
     def get_data(self):
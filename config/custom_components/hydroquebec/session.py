@@ -0,0 +1,157 @@
+"""Cached and persisted authenticated session of the HydroQuebec portal."""
+import asyncio
+import base64
+import copy
+import hashlib
+import json
+import logging
+import time
+
+from homeassistant.helpers.storage import Store
+
+from pyhydroquebec.consts import REQUESTS_TIMEOUT
+from pyhydroquebec.customer import Customer
+from pyhydroquebec.error import PyHydroQuebecError, PyHydroQuebecHTTPError
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 10
+
+# Used when the access token does not tell its expiry
+SESSION_LIFETIME = 30 * 60
+# Log in again a bit before the portal would refuse the session
+EXPIRY_MARGIN = 60
+
+# Site of the consumption pages, where the portal keeps the selected customer
+CONTRACT_SITE = "cl-ec-spring.hydroquebec.com"
+
+
+def token_expiry(token):
+    """Return the expiry (epoch) of a JWT access token, None if it is opaque."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def detach_customer(client, customer, httpsession):
+    """Return a copy of customer on a copy of the logged in client, with its own contract site session.
+
+    The portal selects one customer at a time per session of the contract site:
+    customers detached this way are fetched concurrently with the same login.
+    httpsession must not share a cookie jar with the other detached customers
+    (see the DummyCookieJar), or it would send their contract site session.
+    """
+    detached = copy.copy(client)
+    # pylint: disable=protected-access
+    detached._session = httpsession
+    detached.cookies = {site: dict(cookies) for site, cookies in client.cookies.items() if site != CONTRACT_SITE}
+    detached._selected_customer = None
+    copied = Customer(
+        detached, customer.account_id, customer.customer_id, REQUESTS_TIMEOUT, client.logger.getChild("customer")
+    )
+    copied.contract_id = customer.contract_id
+    detached._customers = [copied]
+    return copied
+
+
+class HydroQuebecSession:
+    """Authenticated session of a HydroQuebec client, logging in only when it expired.
+
+    The access token, cookies and customers of the client are kept with their
+    expiry and persisted, so a restart does not need a new login either.
+    """
+
+    def __init__(self, hass, client, username):
+        """Initialize the session of a client."""
+        self._client = client
+        # Usernames are personal, keep them out of the storage file names
+        key = f"hydroquebec.{hashlib.sha256(username.encode()).hexdigest()[:12]}.session"
+        self._store = Store(hass, STORAGE_VERSION, key, private=True)
+        self._expires = 0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def valid(self):
+        """Return True if the session can still be used."""
+        return time.time() < self._expires - EXPIRY_MARGIN
+
+    def invalidate(self):
+        """Forget the session, the next request logs in again."""
+        self._expires = 0
+
+    def _to_store(self):
+        """Return the session to persist."""
+        client = self._client
+        return {
+            "expires": self._expires,
+            "access_token": client.access_token,
+            "guid": client.guid,
+            "cookies": client.cookies,
+            "customers": [
+                [customer.account_id, customer.customer_id, customer.contract_id]
+                for customer in client.customers
+            ],
+        }
+
+    def _restore(self, stored):
+        """Restore a persisted session into the client. Returns True if still valid."""
+        if not stored or time.time() >= stored["expires"] - EXPIRY_MARGIN:
+            return False
+        client = self._client
+        client.reset()
+        client.access_token = stored["access_token"]
+        client.guid = stored["guid"]
+        client.cookies = stored["cookies"]
+        logger = client.logger.getChild("customer")
+        for account_id, customer_id, contract_id in stored["customers"]:
+            customer = Customer(client, account_id, customer_id, REQUESTS_TIMEOUT, logger)
+            customer.contract_id = contract_id
+            # The client only fills its customers when logging in
+            client._customers.append(customer)  # pylint: disable=protected-access
+        self._expires = stored["expires"]
+        return True
+
+    async def async_login(self):
+        """Log in unless the current session is still valid. Returns False on failure."""
+        async with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                if self._restore(await self._store.async_load()):
+                    _LOGGER.debug("HydroQuebec session restored")
+            if self.valid:
+                return True
+
+            _LOGGER.debug("Logging in HydroQuebec")
+            await self._client.login()
+            # The client logs its login errors and returns without a token
+            if self._client.access_token is None:
+                return False
+            self._expires = token_expiry(self._client.access_token) or time.time() + SESSION_LIFETIME
+            await self._store.async_save(self._to_store())
+            return True
+
+    async def async_call(self, request):
+        """Await request() in a logged in session, logging in again once if it is refused.
+
+        request must look the customers up again when called, as a new login
+        replaces them.
+        """
+        if not await self.async_login():
+            raise PyHydroQuebecError("Unable to log in HydroQuebec")
+        try:
+            result = await request()
+        except PyHydroQuebecHTTPError:
+            # Expired or revoked session: the portal redirects to the login page
+            _LOGGER.debug("HydroQuebec session refused, logging in again")
+            self.invalidate()
+            if not await self.async_login():
+                raise
+            result = await request()
+        # Keep the cookies refreshed by the portal
+        self._store.async_delay_save(self._to_store, STORAGE_SAVE_DELAY)
+        return result
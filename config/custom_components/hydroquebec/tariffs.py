@@ -0,0 +1,179 @@
+"""Cost of the HydroQuebec consumption history under the residential rates."""
+from datetime import timedelta
+import logging
+
+import numpy as np
+
+from .analytics import HOURS
+
+_LOGGER = logging.getLogger(__name__)
+
+RATE_D = "D"
+RATE_DT = "DT"
+RATE_FLEX_D = "Flex D"
+
+# Consumption billed at the base price, per day
+BASE_KWH = 40
+# DT: the higher price applies to the hours colder than this
+DT_TEMPERATURE = -12
+WINTER_MONTHS = (12, 1, 2, 3)
+
+
+class HydroQuebecRate:
+    """Prices of a residential rate, in cents (access per day, energy per kWh)"""
+
+    __slots__ = (
+        "name", "access", "base_price", "high_price",
+        "lower_price", "higher_price",
+        "winter_base_price", "winter_high_price", "peak_price",
+    )
+
+    def __init__(self, name, access, base_price, high_price, lower_price=None, higher_price=None,
+                 winter_base_price=None, winter_high_price=None, peak_price=None):
+        """Initialize a rate; DT has lower/higher prices instead of tiers, Flex D winter and peak prices."""
+        self.name = name
+        self.access = access
+        self.base_price = base_price
+        self.high_price = high_price
+        self.lower_price = lower_price
+        self.higher_price = higher_price
+        self.winter_base_price = winter_base_price
+        self.winter_high_price = winter_high_price
+        self.peak_price = peak_price
+
+
+# In effect since April 1, 2020, taxes excluded
+RATES = {
+    RATE_D: HydroQuebecRate(RATE_D, 40.64, 6.08, 9.38),
+    RATE_DT: HydroQuebecRate(RATE_DT, 40.64, None, None, lower_price=4.28, higher_price=26.07),
+    RATE_FLEX_D: HydroQuebecRate(
+        RATE_FLEX_D, 40.64, 6.08, 9.38,
+        winter_base_price=4.28, winter_high_price=7.36, peak_price=50.00,
+    ),
+}
+
+
+def _tiered(totals, base_price, high_price):
+    """Return the cost (cents) of daily totals billed BASE_KWH at base_price, the rest at high_price."""
+    base = np.minimum(totals, BASE_KWH)
+    return base * base_price + (totals - base) * high_price
+
+
+def _dates(first, days):
+    """Return the datetime64 days from first."""
+    return np.datetime64(first.isoformat(), "D") + np.arange(days)
+
+
+def peak_mask(first, days, peak_events):
+    """Return the (days, 24) mask of the hours of the peak events [(start, end) datetimes] from first."""
+    mask = np.zeros(days * HOURS, dtype=bool)
+    for start, end in peak_events:
+        # Hours started during the event
+        lower = (start.date() - first).days * HOURS + start.hour
+        upper = (end.date() - first).days * HOURS + end.hour + (1 if end.minute or end.second else 0)
+        mask[max(lower, 0):max(upper, 0)] = True
+    return mask.reshape(days, HOURS)
+
+
+def daily_costs(columns, rate, start, end, peak_events=(), billed=None):
+    """Return (first day, cost in CAD of each day), (None, None) without data.
+
+    The days without data cost NaN. Days are billed on their own: BASE_KWH per day
+    like the bills, which prorate it to the days of their period. billed is the rate
+    of the contract: the lower and higher price consumption of the portal are DT
+    bands only under DT, they are estimated from the temperature otherwise.
+    """
+    first, consumption = columns.matrix("total_consumption", start, end)
+    if first is None:
+        return None, None
+    days = len(consumption)
+    totals = np.nansum(consumption, axis=1)
+
+    if rate.lower_price is not None:
+        _, temperature = columns.matrix("average_temperature", start, end)
+        hourly_higher = np.where(temperature < DT_TEMPERATURE, consumption, 0)
+        if billed is not None and billed.name == rate.name:
+            # The bands billed to the DT contract, estimated for the hours without them
+            _, bands = columns.matrix("higher_price_consumption", start, end)
+            hourly_higher = np.where(np.isnan(bands), hourly_higher, bands)
+        higher = np.nansum(hourly_higher, axis=1)
+        energy = (totals - higher) * rate.lower_price + higher * rate.higher_price
+    elif rate.peak_price is not None:
+        peak = np.nansum(np.where(peak_mask(first, days, peak_events), consumption, 0), axis=1)
+        months = _dates(first, days).astype("datetime64[M]").astype(int) % 12 + 1
+        winter = np.isin(months, WINTER_MONTHS)
+        energy = np.where(
+            winter,
+            _tiered(totals - peak, rate.winter_base_price, rate.winter_high_price) + peak * rate.peak_price,
+            _tiered(totals, rate.base_price, rate.high_price),
+        )
+    else:
+        energy = _tiered(totals, rate.base_price, rate.high_price)
+
+    costs = (energy + rate.access) / 100
+    costs[np.all(np.isnan(consumption), axis=1)] = np.nan
+    return first, costs
+
+
+def monthly_costs(first, costs):
+    """Return [(month YYYY-MM, cost, days with data)] of daily costs from first."""
+    months = _dates(first, len(costs)).astype("datetime64[M]")
+    # Index of the first day of each month
+    starts = np.flatnonzero(np.concatenate(([True], months[1:] != months[:-1])))
+    totals = np.add.reduceat(np.nan_to_num(costs), starts)
+    counts = np.add.reduceat(~np.isnan(costs), starts)
+    return [
+        (str(months[index]), round(float(total), 2), int(count))
+        for index, total, count in zip(starts, totals, counts)
+    ]
+
+
+def compare(columns, start, end, peak_events=(), rates=None, billed=None):
+    """Return {rate: cost in CAD} of the period under each rate (what-if), billed being the contract rate."""
+    result = {}
+    for name, rate in (rates or RATES).items():
+        _, costs = daily_costs(columns, rate, start, end, peak_events, billed)
+        result[name] = None if costs is None else round(float(np.nansum(costs)), 2)
+    return result
+
+
+def cost_report(columns, rate, start, end, peak_events=(), billed=None):
+    """Return the daily, monthly and total costs of a period under rate, and under the other rates."""
+    first, costs = daily_costs(columns, rate, start, end, peak_events, billed)
+    if first is None:
+        return None
+    what_if = compare(columns, start, end, peak_events, billed=billed)
+    return {
+        "rate": rate.name,
+        "start": first.isoformat(),
+        "end": (first + timedelta(days=len(costs) - 1)).isoformat(),
+        "total_cost": round(float(np.nansum(costs)), 2),
+        "daily": [
+            {"date": (first + timedelta(days=int(index))).isoformat(), "cost": round(float(costs[index]), 2)}
+            for index in np.flatnonzero(~np.isnan(costs))
+        ],
+        "monthly": [
+            {"month": month, "cost": cost, "days": days}
+            for month, cost, days in monthly_costs(first, costs)
+            if days
+        ],
+        "what_if": what_if,
+        "cheapest_rate": min(
+            (name for name in what_if if what_if[name] is not None), key=what_if.get, default=None
+        ),
+    }
+
+
+def summarize_costs(columns, rate, peak_events=()):
+    """Return the costs shown by the sensors, rate being the contract rate: last day of data and its month."""
+    end = columns.last_day
+    if end is None:
+        return None
+    first, costs = daily_costs(columns, rate, end.replace(day=1), end, peak_events, rate)
+    if first is None or np.isnan(costs[-1]):
+        return None
+    return {
+        "date": end.isoformat(),
+        "day_cost": round(float(costs[-1]), 2),
+        "month_cost": round(float(np.nansum(costs)), 2),
+    }
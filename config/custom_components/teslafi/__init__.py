@@ -1,25 +1,58 @@
 """Support for Tesla cars data through TeslaFi"""
 from datetime import timedelta
-from urllib.request import Request, build_opener
-from urllib.error import HTTPError
-from urllib.parse import urlencode
+import asyncio
+import hashlib
 import logging
-import json
+import random
 import time
 import voluptuous as vol
 
 from homeassistant.const import (
     CONF_ACCESS_TOKEN,
     CONF_SCAN_INTERVAL,
+    CONF_TIMEOUT,
+    CONF_URL,
+    EVENT_HOMEASSISTANT_STOP,
 )
+from homeassistant.core import callback
 
 # from homeassistant.helpers.entity_component import EntityComponent
 # from homeassistant.components.input_number import InputNumber
 
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers import discovery
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity
-from homeassistant.util import Throttle
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
+from homeassistant.util import dt as dt_util
+
+from .catalogue import DEFAULT_FIELDS
+from .charging import CHARGING_KEYS, TeslaFiChargingTracker, TeslaFiSessionLog
+from .commands import TeslaFiCommandQueue
+from .overlay import TeslaFiOverlay
+from .changes import (
+    KEY_CHARGING_SESSION,
+    KEY_FEED_KEYS,
+    KEY_METRICS,
+    KEY_ONLINE,
+    KEY_STALE,
+    KEY_TRIP,
+    TeslaFiChangeDetector,
+)
+from .metrics import ENDPOINT_COMMAND, ENDPOINT_CURRENT, ENDPOINT_LAST_GOOD, TeslaFiMetrics
+from .snapshot import TeslaFiSchema
+from .snapshotlog import (
+    DEFAULT_REPLAY_SPEED,
+    TeslaFiReplay,
+    TeslaFiSnapshotLog,
+    TeslaFiSnapshotReader,
+)
+from .transport import NOT_MODIFIED, TeslaFiCircuitOpenError, TeslaFiError, TeslaFiTransport
+from .timeseries import DEFAULT_HISTORY_FIELDS, MAX_WINDOW, TeslaFiHistory
+from .trips import TRIP_KEYS, TeslaFiTripBuilder, TeslaFiTripStore
+from .zones import TeslaFiZoneIndex
+from .scheduler import POLLING_STATES, STATE_ONLINE, TeslaFiPollScheduler
 
 """=================================================================================================================="""
 
@@ -27,20 +60,139 @@ DOMAIN = "teslafi"
 
 _LOGGER = logging.getLogger(__name__)
 
+DEFAULT_URL = 'https://www.teslafi.com'
 SCAN_INTERVAL = timedelta(seconds=60)
+DEFAULT_TIMEOUT = 15
+DEFAULT_MAX_CONCURRENT_POLLS = 4
+DEFAULT_MIN_DISTANCE = 25
+DEFAULT_MIN_HEADING = 45
+DEFAULT_TRACE_TOLERANCE = 15
+DEFAULT_BATTERY_CAPACITY = 75
+DEFAULT_TRIP_COUNT = 10
+
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 300
+# Vehicles started from cached data are refreshed within this window
+STARTUP_REFRESH_WINDOW = 10
+
+CONF_ACCOUNTS = "accounts"
+CONF_MAX_CONCURRENT_POLLS = "max_concurrent_polls"
+CONF_POLLING = "polling"
+CONF_DEADBANDS = "deadbands"
+CONF_HISTORY = "history"
+CONF_MIN_DISTANCE = "min_distance"
+CONF_MIN_HEADING = "min_heading"
+CONF_TRACE_TOLERANCE = "trace_tolerance"
+CONF_BATTERY_CAPACITY = "battery_capacity"
+CONF_FIELDS = "fields"
+CONF_DISCOVER_FIELDS = "discover_fields"
+CONF_METRICS = "metrics"
+CONF_SNAPSHOT_LOG = "snapshot_log"
+CONF_REPLAY = "replay"
+CONF_SPEED = "speed"
+CONF_START = "start"
+
+ATTR_VEHICLE = "vehicle"
+ATTR_FIELD = "field"
+ATTR_WINDOW = "window"
+ATTR_COUNT = "count"
+ATTR_DATE = "date"
+
+SERVICE_QUERY_HISTORY = "query_history"
+EVENT_HISTORY = "teslafi_history"
+EVENT_CHARGING_SESSION = "teslafi_charging_session"
+SERVICE_QUERY_TRIPS = "query_trips"
+EVENT_TRIP = "teslafi_trip"
+EVENT_TRIPS = "teslafi_trips"
+SERVICE_DUMP_METRICS = "dump_metrics"
+EVENT_METRICS = "teslafi_metrics"
+
+REPLAY_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_SPEED, default=DEFAULT_REPLAY_SPEED): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1)
+        ),
+        vol.Optional(CONF_START): cv.datetime,
+    }
+)
+
+POLLING_SCHEMA = vol.Schema({vol.Optional(state): cv.time_period for state in POLLING_STATES})
+
+DEADBANDS_SCHEMA = vol.Schema({cv.string: vol.All(vol.Coerce(float), vol.Range(min=0))})
+
+ACCOUNT_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_ACCESS_TOKEN): cv.string,
+        vol.Optional(CONF_SCAN_INTERVAL): cv.time_period,
+        vol.Optional(CONF_TIMEOUT): cv.positive_int,
+        vol.Optional(CONF_POLLING): POLLING_SCHEMA,
+        vol.Optional(CONF_BATTERY_CAPACITY): vol.Coerce(float),
+    }
+)
 
 CONFIG_SCHEMA = vol.Schema(
     {
-        DOMAIN: vol.Schema(
-            {
-                vol.Required(CONF_ACCESS_TOKEN): cv.string,
-                vol.Optional(CONF_SCAN_INTERVAL, default=SCAN_INTERVAL): cv.time_period,
-            }
+        DOMAIN: vol.All(
+            vol.Schema(
+                {
+                    vol.Optional(CONF_ACCESS_TOKEN): cv.string,
+                    vol.Optional(CONF_ACCOUNTS): vol.All(cv.ensure_list, [ACCOUNT_SCHEMA]),
+                    vol.Optional(CONF_SCAN_INTERVAL, default=SCAN_INTERVAL): cv.time_period,
+                    vol.Optional(CONF_TIMEOUT, default=DEFAULT_TIMEOUT): cv.positive_int,
+                    vol.Optional(CONF_POLLING, default={}): POLLING_SCHEMA,
+                    vol.Optional(CONF_DEADBANDS, default={}): DEADBANDS_SCHEMA,
+                    vol.Optional(CONF_HISTORY, default=DEFAULT_HISTORY_FIELDS): vol.All(
+                        cv.ensure_list, [cv.string]
+                    ),
+                    vol.Optional(CONF_MIN_DISTANCE, default=DEFAULT_MIN_DISTANCE): vol.Coerce(float),
+                    vol.Optional(CONF_MIN_HEADING, default=DEFAULT_MIN_HEADING): vol.All(
+                        vol.Coerce(float), vol.Range(min=0, max=180)
+                    ),
+                    vol.Optional(
+                        CONF_TRACE_TOLERANCE, default=DEFAULT_TRACE_TOLERANCE
+                    ): vol.Coerce(float),
+                    vol.Optional(
+                        CONF_BATTERY_CAPACITY, default=DEFAULT_BATTERY_CAPACITY
+                    ): vol.Coerce(float),
+                    vol.Optional(
+                        CONF_MAX_CONCURRENT_POLLS, default=DEFAULT_MAX_CONCURRENT_POLLS
+                    ): cv.positive_int,
+                    vol.Optional(CONF_FIELDS, default=DEFAULT_FIELDS): vol.All(
+                        cv.ensure_list, [cv.string]
+                    ),
+                    vol.Optional(CONF_DISCOVER_FIELDS, default=True): cv.boolean,
+                    # TeslaFi itself, or a local stand-in such as the benchmark feed
+                    vol.Optional(CONF_URL, default=DEFAULT_URL): cv.url,
+                    vol.Optional(CONF_METRICS, default=False): cv.boolean,
+                    vol.Optional(CONF_SNAPSHOT_LOG, default=False): cv.boolean,
+                    # Replay the snapshot logs instead of polling TeslaFi
+                    vol.Optional(CONF_REPLAY): REPLAY_SCHEMA,
+                }
+            ),
+            cv.has_at_least_one_key(CONF_ACCESS_TOKEN, CONF_ACCOUNTS),
         )
     },
     extra=vol.ALLOW_EXTRA,
 )
 
+QUERY_HISTORY_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_VEHICLE): cv.string,
+        vol.Required(ATTR_FIELD): cv.string,
+        vol.Required(ATTR_WINDOW): vol.All(cv.time_period, vol.Range(max=timedelta(seconds=MAX_WINDOW))),
+    }
+)
+
+QUERY_TRIPS_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_VEHICLE): cv.string,
+        vol.Exclusive(ATTR_COUNT, "trips"): cv.positive_int,
+        vol.Exclusive(ATTR_DATE, "trips"): cv.date,
+    }
+)
+
+DUMP_METRICS_SCHEMA = vol.Schema({vol.Optional(ATTR_VEHICLE): cv.string})
+
 NOTIFICATION_ID = "teslafi_integration_notification"
 NOTIFICATION_TITLE = "TeslaFi integration setup"
 
@@ -53,17 +205,110 @@ async def async_setup(hass, base_config):
 
     config = base_config.get(DOMAIN)
 
-    token = config.get(CONF_ACCESS_TOKEN)
-    scan_interval = config.get(CONF_SCAN_INTERVAL)
+    accounts = list(config.get(CONF_ACCOUNTS, []))
+    if CONF_ACCESS_TOKEN in config:
+        accounts.insert(0, {CONF_ACCESS_TOKEN: config[CONF_ACCESS_TOKEN]})
+
+    # Shared keep-alive session, so each poll reuses a warm connection
+    session = async_get_clientsession(hass)
+    pool = TeslaFiPool(hass, config.get(CONF_MAX_CONCURRENT_POLLS))
+    zones = TeslaFiZoneIndex(hass)
+
+    for account in accounts:
+        scan_interval = account.get(CONF_SCAN_INTERVAL, config.get(CONF_SCAN_INTERVAL))
+        # The scan interval is the polling interval of an awake, idle vehicle
+        polling = {STATE_ONLINE: scan_interval}
+        polling.update(config.get(CONF_POLLING))
+        polling.update(account.get(CONF_POLLING, {}))
+
+        pool.add(
+            TeslaFi(
+                hass,
+                session,
+                account[CONF_ACCESS_TOKEN],
+                scan_interval,
+                timeout=account.get(CONF_TIMEOUT, config.get(CONF_TIMEOUT)),
+                semaphore=pool.semaphore,
+                scheduler=TeslaFiPollScheduler(polling),
+                deadbands=config.get(CONF_DEADBANDS),
+                history_fields=config.get(CONF_HISTORY),
+                trace_tolerance=config.get(CONF_TRACE_TOLERANCE),
+                battery_capacity=account.get(CONF_BATTERY_CAPACITY, config.get(CONF_BATTERY_CAPACITY)),
+                base_url=config.get(CONF_URL),
+                metrics=config.get(CONF_METRICS),
+                snapshot_log=config.get(CONF_SNAPSHOT_LOG),
+                replay=config.get(CONF_REPLAY),
+                zones=zones,
+            )
+        )
+
+    if not await pool.async_initialize():
+        _LOGGER.error("Unable to retrieve vehicle data from TeslaFi")
+        return False
 
-    controller = TeslaFi(token, scan_interval)
+    # One fetch per interval and vehicle, pushed to every subscribed entity
+    pool.async_start()
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, pool.async_stop)
 
+    zones.async_start()
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, zones.async_stop)
 
     if hass.data.get(DOMAIN) is None:
         hass.data[DOMAIN] = {
-            "controller": controller
+            "config": config,
+            "pool": pool,
+            "controllers": pool.controllers,
+            "zones": zones,
         }
 
+    async def async_query_history(call):
+        """Fire an event with the windowed statistics of a field."""
+        now = time.time()
+        window = call.data[ATTR_WINDOW].total_seconds()
+        for controller in pool.get(call.data.get(ATTR_VEHICLE)):
+            hass.bus.async_fire(EVENT_HISTORY, {
+                ATTR_VEHICLE: controller.name(),
+                ATTR_FIELD: call.data[ATTR_FIELD],
+                ATTR_WINDOW: window,
+                "result": controller.history.query(call.data[ATTR_FIELD], window, now),
+            })
+
+    hass.services.async_register(
+        DOMAIN, SERVICE_QUERY_HISTORY, async_query_history, schema=QUERY_HISTORY_SCHEMA
+    )
+
+    async def async_query_trips(call):
+        """Fire an event with the last trips, or the trips of a day."""
+        date = call.data.get(ATTR_DATE)
+        for controller in pool.get(call.data.get(ATTR_VEHICLE)):
+            if date is not None:
+                trips = await hass.async_add_executor_job(
+                    controller.trip_store.on_date, date.isoformat()
+                )
+            else:
+                trips = await hass.async_add_executor_job(
+                    controller.trip_store.last, call.data.get(ATTR_COUNT, DEFAULT_TRIP_COUNT)
+                )
+            hass.bus.async_fire(EVENT_TRIPS, {ATTR_VEHICLE: controller.name(), "trips": trips})
+
+    hass.services.async_register(
+        DOMAIN, SERVICE_QUERY_TRIPS, async_query_trips, schema=QUERY_TRIPS_SCHEMA
+    )
+
+    async def async_dump_metrics(call):
+        """Log the metrics and fire an event with them."""
+        if not config.get(CONF_METRICS):
+            _LOGGER.warning("TeslaFi metrics are disabled, set '%s: true' to collect them", CONF_METRICS)
+            return
+        for controller in pool.get(call.data.get(ATTR_VEHICLE)):
+            metrics = controller.metrics.as_dict()
+            _LOGGER.info("TeslaFi metrics of %s: %s", controller.name(), metrics)
+            hass.bus.async_fire(EVENT_METRICS, {ATTR_VEHICLE: controller.name(), "metrics": metrics})
+
+    hass.services.async_register(
+        DOMAIN, SERVICE_DUMP_METRICS, async_dump_metrics, schema=DUMP_METRICS_SCHEMA
+    )
+
     for component in TESLAFI_COMPONENTS:
         hass.async_create_task(discovery.async_load_platform(hass, component, DOMAIN, {}, base_config))
 
@@ -86,84 +331,523 @@ async def async_setup(hass, base_config):
 
 """=================================================================================================================="""
 
+class TeslaFiPool:
+    """Pool of TeslaFi controllers sharing a bounded number of concurrent polls"""
+
+    def __init__(self, hass, max_concurrent):
+        """Initialise the pool."""
+        self._hass = hass
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.controllers = []
+
+    def add(self, controller):
+        """Add a controller to the pool."""
+        self.controllers.append(controller)
+
+    def get(self, vehicle=None):
+        """Return the controllers matching a vehicle name or VIN, all of them if None."""
+        if vehicle is None:
+            return list(self.controllers)
+        return [
+            controller for controller in self.controllers
+            if vehicle in (controller.name(), controller.vin)
+        ]
+
+    async def async_initialize(self):
+        """Initialise all the controllers concurrently, dropping the failed ones."""
+        results = await asyncio.gather(
+            *[controller.async_initialize() for controller in self.controllers]
+        )
+        for controller, result in zip(list(self.controllers), results):
+            if not result:
+                _LOGGER.error("Unable to initialise TeslaFi vehicle, ignoring it")
+                self.controllers.remove(controller)
+        return bool(self.controllers)
+
+    @callback
+    def async_start(self):
+        """Start polling, spreading the first poll of each controller over its interval."""
+        for controller in self.controllers:
+            window = controller.scan_interval.total_seconds()
+            if controller.restored:
+                window = min(window, STARTUP_REFRESH_WINDOW)
+            controller.async_start(random.uniform(0, window))
+
+    @callback
+    def async_stop(self, event=None):
+        """Stop polling all the controllers."""
+        for controller in self.controllers:
+            controller.async_stop()
+
+"""=================================================================================================================="""
+
 class TeslaFi:
     """Representation of a TeslaFi account / connection"""
 
-    def __init__(self, token, scan_interval):
+    def __init__(self, hass, session, token, scan_interval, *, timeout=DEFAULT_TIMEOUT, semaphore=None,
+                 scheduler=None, deadbands=None, history_fields=None,
+                 trace_tolerance=DEFAULT_TRACE_TOLERANCE, battery_capacity=DEFAULT_BATTERY_CAPACITY,
+                 base_url=DEFAULT_URL, metrics=False, snapshot_log=False, replay=None, zones=None):
         """Initialise of the TeslaFi device."""
 
         _LOGGER.debug("Initialising TeslaFi API")
 
-        self._baseurl = 'https://www.teslafi.com'
+        self._hass = hass
+        # Only allocated when enabled, the hot paths skip them otherwise
+        self.metrics = TeslaFiMetrics() if metrics else None
+        self._transport = TeslaFiTransport(session, timeout, metrics=self.metrics)
+        self._semaphore = semaphore if semaphore is not None else asyncio.Semaphore(1)
+
+        # Tokens are secrets, keep them out of the storage file names
+        storage_key = f"{DOMAIN}.{hashlib.sha256(token.encode()).hexdigest()[:12]}"
+        log_path = hass.config.path(".storage", f"{storage_key}.snapshots")
+        self.snapshot_log = None
+        self._replay = None
+        self._replay_task = None
+        if replay is not None:
+            start = replay.get(CONF_START)
+            self._replay = TeslaFiReplay(
+                TeslaFiSnapshotReader(TeslaFiSnapshotLog(log_path).files()),
+                replay[CONF_SPEED],
+                None if start is None else dt_util.as_timestamp(start),
+            )
+            self._transport = self._replay
+            # Replayed trips, sessions and cache are kept apart from the real ones
+            storage_key += ".replay"
+        elif snapshot_log:
+            self.snapshot_log = TeslaFiSnapshotLog(log_path)
+        self._store = Store(hass, STORAGE_VERSION, storage_key)
+        self._restored = False
+
+        self._baseurl = base_url.rstrip('/')
         self._api_actual = '/feed.php?token=' + token
         self._api_last = '/feed.php?command=lastGood&token=' + token
         self._api_command = '&command='
 
         self._scan_interval = scan_interval
+        self._scheduler = scheduler if scheduler is not None else TeslaFiPollScheduler(
+            {STATE_ONLINE: scan_interval}
+        )
 
         self._id = None
         self._vehicle_id = None
         self._display_name = None
         self._vin = None
 
+        self.history = TeslaFiHistory(history_fields)
+        self.charging = TeslaFiChargingTracker()
+        self.sessions = TeslaFiSessionLog(hass.config.path(".storage", f"{storage_key}.sessions"))
+        self.trips = TeslaFiTripBuilder(trace_tolerance)
+        self.trip_store = TeslaFiTripStore(hass.config.path(".storage", f"{storage_key}.trips"))
+        self.last_trip = None
+        self._battery_capacity = battery_capacity
+        # Zone index shared by the vehicles, learning the place names they report
+        self.zones = zones
+
+        self._schema = TeslaFiSchema(self._base_keys())
+        self._data = None
+        self._last_data = None
         self._was_online = True
-        self._update()
-        self.update = Throttle(self._scan_interval)(self._update)
-
-        if self.is_online():
-            dataId = self._data
-        else:
+        self._stale = False
+        # feed -> last snapshot parsed, reused when the feed did not change
+        self._snapshots = {}
+        # Keys valued in the first whole feed of the vehicle online, for the catalogue discovery
+        self.feed_keys = None
+
+        self._changes = TeslaFiChangeDetector(deadbands)
+        self._overlay = TeslaFiOverlay()
+        self._unsub_overlay = None
+        self._commands = TeslaFiCommandQueue(
+            hass, self._async_send_now, self.is_online, self.async_request_refresh
+        )
+        self._listeners = []
+        self._key_listeners = {}
+        self._unsub_refresh = None
+        self._started = False
+
+    def _base_keys(self):
+        """Return the keys needed by the controller itself."""
+        return self.history.fields + CHARGING_KEYS + TRIP_KEYS
+
+    async def async_initialize(self):
+        """Load the vehicle identity from the cache, or fetch the first data."""
+        if self._replay is not None:
+            await self._hass.async_add_executor_job(self._replay.open)
+        last_sessions = await self._hass.async_add_executor_job(self.sessions.read, 1)
+        if last_sessions:
+            self.charging.last = last_sessions[-1]
+        await self._hass.async_add_executor_job(self.trip_store.load)
+        last_trips = await self._hass.async_add_executor_job(self.trip_store.last, 1)
+        if last_trips:
+            self.last_trip = last_trips[-1]
+
+        stored = await self._store.async_load()
+        if stored and stored.get('data'):
+            # Start from the last good data, the network refresh runs in the background
+            self._schema = TeslaFiSchema(tuple(stored['data']) + self._base_keys())
+            self._last_data = self._schema.parse(stored['data'])
+            self._was_online = False
+            self._restored = True
             dataId = self._last_data
+        else:
+            async with self._semaphore:
+                await self._async_update()
+
+            if self.is_online():
+                dataId = self._data
+            else:
+                dataId = self._last_data
+
+        if not dataId:
+            return False
 
         self._id = dataId['id']
         self._vehicle_id = dataId['vehicle_id']
-        self._display_name = dataId['display_name'].replace(" ", "").lower()
+        self._display_name = (dataId['display_name'] or '').replace(" ", "").lower() or None
         self._vin = dataId['vin']
 
-        _LOGGER.debug("TeslaFi API Initialized")
+        _LOGGER.debug("TeslaFi API Initialized%s", " from cache" if self._restored else "")
+        return True
+
+    @property
+    def vin(self):
+        """Return the VIN of the vehicle."""
+        return self._vin
+
+    @property
+    def restored(self):
+        """Return True if the controller started from cached data."""
+        return self._restored
+
+    @property
+    def scan_interval(self):
+        """Return the polling interval."""
+        return self._scan_interval
+
+    @callback
+    def _data_to_store(self):
+        """Return the data to persist: the last good snapshot."""
+        return {'data': self._last_data.as_dict()}
+
+    @callback
+    def async_start(self, delay=0):
+        """Start the periodic refresh of the vehicle data after an initial delay."""
+        if self._replay is not None:
+            # The replay drives the refreshes, not the poll timer
+            if self._replay_task is None:
+                self._replay_task = self._hass.async_create_task(self._replay.async_run(self))
+            return
+        if self._started:
+            return
+        self._started = True
+        self._async_schedule_refresh(delay)
+
+    @callback
+    def async_stop(self, event=None):
+        """Stop the periodic refresh of the vehicle data."""
+        self._started = False
+        if self._unsub_refresh is not None:
+            self._unsub_refresh()
+            self._unsub_refresh = None
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            self._replay_task = None
+            self._replay.close()
+
+    @callback
+    def _async_schedule_refresh(self, delay):
+        """Schedule the next refresh, replacing the pending one."""
+        if self._unsub_refresh is not None:
+            self._unsub_refresh()
+        self._unsub_refresh = async_call_later(self._hass, delay, self._async_handle_refresh_timer)
+
+    @callback
+    def async_request_refresh(self, delay=0):
+        """Refresh the vehicle data after a delay, instead of the scheduled poll."""
+        if self._started:
+            self._async_schedule_refresh(delay)
+
+    async def _async_handle_refresh_timer(self, now):
+        """Run the scheduled refresh."""
+        self._unsub_refresh = None
+        await self.async_refresh()
+
+    @callback
+    def async_add_listener(self, update_callback, keys=None):
+        """Subscribe to changes of the given keys (any change if None). Returns a function to unsubscribe."""
+        if keys is None:
+            self._listeners.append(update_callback)
+        else:
+            keys = set(keys)
+            for key in keys:
+                self._key_listeners.setdefault(key, []).append(update_callback)
+            self._async_project(keys)
+
+        @callback
+        def remove_listener():
+            if keys is None:
+                self._listeners.remove(update_callback)
+                return
+            for key in keys:
+                self._key_listeners[key].remove(update_callback)
+                if not self._key_listeners[key]:
+                    del self._key_listeners[key]
+
+        return remove_listener
+
+    @callback
+    def _async_project(self, keys):
+        """Extend the snapshot projection with new keys, fetching them soon."""
+        missing = [key for key in keys if key not in self._schema.index and not key.startswith('_')]
+        if not missing:
+            return
+        self._schema = TeslaFiSchema(self._schema.keys + tuple(missing))
+        # Cached snapshots lack the new keys
+        self._transport.invalidate()
+        self._snapshots.clear()
+        # Entities registering together share a single refresh
+        if self._started:
+            self._async_schedule_refresh(0)
+
+    @callback
+    def async_set_optimistic(self, key, value):
+        """Show an optimistic value until a poll confirms or contradicts it, or it expires."""
+        self._overlay.set(key, value)
+        self._async_schedule_overlay_expiry()
+        self._async_notify({key})
+
+    @callback
+    def _async_schedule_overlay_expiry(self):
+        """Schedule the expiry of the next optimistic value."""
+        if self._unsub_overlay is not None:
+            self._unsub_overlay()
+            self._unsub_overlay = None
+        expiry = self._overlay.next_expiry()
+        if expiry is not None:
+            self._unsub_overlay = async_call_later(
+                self._hass, max(0, expiry - time.monotonic()), self._async_handle_overlay_expiry
+            )
+
+    @callback
+    def _async_handle_overlay_expiry(self, now):
+        """Drop the expired optimistic values."""
+        self._unsub_overlay = None
+        expired = self._overlay.expire()
+        self._async_schedule_overlay_expiry()
+        self._async_notify(expired)
+
+    @callback
+    def _async_notify(self, changes):
+        """Call once every listener subscribed to one of the changed keys."""
+        if not changes:
+            return
+
+        notified = set()
+        for update_callback in list(self._listeners):
+            notified.add(update_callback)
+            update_callback()
+
+        for key in changes:
+            for update_callback in list(self._key_listeners.get(key, ())):
+                if update_callback not in notified:
+                    notified.add(update_callback)
+                    update_callback()
+
+    async def async_refresh(self, now=None):
+        """Fetch the data once and push it to all the listeners."""
+        was_stale = self._stale
+        had_feed_keys = self.feed_keys is not None
+        try:
+            async with self._semaphore:
+                fetched_at = time.monotonic()
+                await self._async_update()
+        finally:
+            # The next poll depends on what the vehicle is doing now, and on TeslaFi being reachable
+            if self._started:
+                self._async_schedule_refresh(max(
+                    self._scheduler.next_interval(self._data, self.is_online()).total_seconds(),
+                    self._transport.breaker.retry_in(),
+                ))
+
+        online = self.is_online()
+        changes = set()
+        if self._stale != was_stale:
+            changes.add(KEY_STALE)
+        if self.feed_keys is not None and not had_feed_keys:
+            changes.add(KEY_FEED_KEYS)
+        # Replayed snapshots are processed at their recording time
+        now = time.time() if self._replay is None else self._replay.time()
+        if self.snapshot_log is not None and not self._stale and self._data is not None:
+            self._hass.async_add_executor_job(self.snapshot_log.append, now, self._data.as_dict())
+        if online and not self._stale:
+            self.history.record(self._data, now)
+            charging = self.charging.current is not None
+            finished = self.charging.update(self._data, now)
+            if finished is not None:
+                self._async_session_finished(finished)
+            if finished is not None or charging != (self.charging.current is not None):
+                changes.add(KEY_CHARGING_SESSION)
+            trip = self.trips.update(self._data, now)
+            if trip is not None:
+                self._async_trip_finished(trip)
+                changes.add(KEY_TRIP)
+            if self.zones is not None:
+                self._learn_place()
+        else:
+            # Closed at the last snapshot online, not whenever the vehicle is back
+            finished = self.charging.interrupt()
+            if finished is not None:
+                self._async_session_finished(finished)
+                changes.add(KEY_CHARGING_SESSION)
+
+        changes |= self._changes.diff(self._data if online else self._last_data, online)
+        _LOGGER.debug("TeslaFi changed keys: %s", changes)
+        if self._overlay:
+            # A failed poll left the data from before the commands: nothing to reconcile with
+            if not self._stale:
+                changes |= self._overlay.reconcile(self._data, fetched_at)
+            self._async_schedule_overlay_expiry()
+
+        if self.metrics is None:
+            self._async_notify(changes)
+        else:
+            if KEY_ONLINE in changes:
+                self.metrics.record_transition(online)
+            changes.add(KEY_METRICS)
+            started = time.perf_counter()
+            self._async_notify(changes)
+            self.metrics.record_fan_out(time.perf_counter() - started)
+            changes.discard(KEY_METRICS)
+
+        if changes and self._last_data is not None:
+            self._store.async_delay_save(self._data_to_store, STORAGE_SAVE_DELAY)
+
+    def _learn_place(self):
+        """Remember the place name reported at the current position."""
+        lat = self._data['latitude']
+        lon = self._data['longitude']
+        if lat is not None and lon is not None:
+            self.zones.learn_place(lat, lon, self._data['location'])
+
+    @callback
+    def _async_session_finished(self, session):
+        """Publish and log a finished charging session."""
+        self._hass.bus.async_fire(
+            EVENT_CHARGING_SESSION, dict(session.as_dict(), vehicle=self.name())
+        )
+        self._hass.async_add_executor_job(self.sessions.append, session)
+
+    @callback
+    def _async_trip_finished(self, trip):
+        """Publish and store a finished trip."""
+        self.last_trip = trip.as_dict(self._battery_capacity)
+        date = dt_util.as_local(dt_util.utc_from_timestamp(trip.start)).date().isoformat()
+        self._hass.bus.async_fire(EVENT_TRIP, dict(self.last_trip, vehicle=self.name()))
+        self._hass.async_add_executor_job(self.trip_store.append, date, self.last_trip)
+
+    @property
+    def last_charging_session(self):
+        """Return the last finished charging session as a dict."""
+        return None if self.charging.last is None else self.charging.last.as_dict()
 
     def is_online(self):
         return not ((not self._data) or (self._data['id'] is None))
-        
-    def _get_data(self):
-        return self._get(self._api_actual)
 
-    def _get_last_data(self):
-        return self._get(self._api_last)
+    def is_stale(self):
+        """Return True if the data could not be refreshed at the last poll."""
+        return self._stale
+
+    async def _async_get_data(self):
+        return await self._async_get_snapshot(self._api_actual)
+
+    async def _async_get_last_data(self):
+        return await self._async_get_snapshot(self._api_last)
+
+    async def _async_get_snapshot(self, feed):
+        """Fetch and parse a feed, reusing the last snapshot if the feed did not change."""
+        if feed not in self._snapshots:
+            # Nothing to reuse: fetch and parse the feed in full
+            self._transport.invalidate(self._baseurl + feed)
+        raw = await self._async_get(feed, conditional=True)
+        if self.metrics is not None and raw is not None:
+            self.metrics.record_cache(raw is NOT_MODIFIED)
+        if raw is NOT_MODIFIED:
+            return self._snapshots[feed]
+        snapshot = self._schema.parse(raw)
+        if snapshot is not None:
+            self._snapshots[feed] = snapshot
+            if self.feed_keys is None and snapshot['id'] is not None:
+                # The feed has every key, the snapshot only the projected ones
+                self.feed_keys = frozenset(key for key, value in raw.items() if value not in (None, ''))
+        else:
+            self._snapshots.pop(feed, None)
+            self._transport.invalidate(self._baseurl + feed)
+        return snapshot
+
+    async def async_send(self, command):
+        """Queue a command. Returns the response, or None if superseded or failed."""
+        return await self._commands.async_send(command)
 
-    def send(self, command):
+    async def _async_send_now(self, command):
         _LOGGER.debug("Sending command TeslaFi API")
-        return self._get(self._api_actual, self._api_command + command)
+        # Not retried here, the command queue retries
+        return await self._async_get(self._api_actual, self._api_command + command, retry=False)
 
-    def _get(self, feed, command=None):
+    async def _async_get(self, feed, command=None, retry=True, conditional=False):
         if feed == self._api_actual:
             _LOGGER.debug("Querying TeslaFi API current data")
         else:
             _LOGGER.debug("Querying TeslaFi API last data")
 
+        url = "%s%s" % (self._baseurl, feed if command is None else feed + command)
+        if self.metrics is not None:
+            return await self._async_get_measured(url, feed, command, retry, conditional)
+        return await self._async_get_url(url, retry, conditional)
+
+    async def _async_get_measured(self, url, feed, command, retry, conditional):
+        """Get an url, recording the latency of its endpoint."""
+        if command is not None:
+            endpoint = ENDPOINT_COMMAND
+        elif feed == self._api_last:
+            endpoint = ENDPOINT_LAST_GOOD
+        else:
+            endpoint = ENDPOINT_CURRENT
+        started = time.perf_counter()
+        result = await self._async_get_url(url, retry, conditional)
+        self.metrics.record_request(endpoint, time.perf_counter() - started, result is not None)
+        return result
+
+    async def _async_get_url(self, url, retry, conditional):
         try:
-            req = Request("%s%s" % (self._baseurl, feed if command is None else feed + command))
-            opener = build_opener()
-            resp = opener.open(req)
-            charset = resp.info().get('charset', 'utf-8')
-            data = json.loads(resp.read().decode(charset))
-            opener.close()
-            #_LOGGER.debug(json.dumps(data))
-            return data
-        except HTTPError as exception_:
-            _LOGGER.error("Error communicating with TeslaFi API: %s", exception_)
-            return None
-
-    def _update(self):
-        self._data = self._get_data();
+            return await self._transport.async_get(url, retry, conditional)
+        except TeslaFiCircuitOpenError as exception_:
+            _LOGGER.debug("TeslaFi API not queried: %s", exception_)
+        except TeslaFiError as exception_:
+            if exception_.transient:
+                _LOGGER.warning("Error communicating with TeslaFi API: %s", exception_)
+            else:
+                _LOGGER.error("Error communicating with TeslaFi API: %s", exception_)
+        return None
+
+    async def _async_update(self):
+        data = await self._async_get_data()
+        if data is None:
+            # Keep serving the last snapshot, marked stale, while TeslaFi is unreachable
+            self._stale = True
+            return
+        self._stale = False
+        self._data = data
 
         if self.is_online():
             self._last_data = self._data
             self._was_online = True
         else:
             if self._was_online:
-                self._last_data = self._get_last_data()
-                self._was_online = False
+                last_data = await self._async_get_last_data()
+                # Retried at the next poll if TeslaFi is unreachable
+                if last_data is not None:
+                    self._last_data = last_data
+                    self._was_online = False
 
     def name(self):
         return ('{}'.format(self._display_name) if
@@ -179,6 +863,16 @@ class TeslaFi:
     def get_last_data(self):
         return self._last_data
 
+    def get_value(self, key):
+        """Return the current value of a key, optimistic values first."""
+        if key in self._overlay:
+            return self._overlay.get(key)
+        return None if self._data is None else self._data[key]
+
+    def get_last_value(self, key):
+        """Return the last good value of a key."""
+        return None if self._last_data is None else self._last_data[key]
+
 """=================================================================================================================="""
 
 class TeslaFiDevice(Entity):
@@ -195,11 +889,10 @@ class TeslaFiDevice(Entity):
         self._name = f"teslafi_{self._controller.name()}"
         self._uid = f"teslafi_{self._controller.uniq_name()}"
 
-        self._current_value = None
-        self._last_value = None
         self._unit = None
 
-        self._should_poll = True
+        self._should_poll = False
+        self._unsub_listener = None
         self._is_online = False
         self._available = False
         self._assumed_state = False
@@ -241,15 +934,31 @@ class TeslaFiDevice(Entity):
         """Icon handling."""
         return "mdi:car"
 
-    def update(self, force=False):
+    async def async_update(self, force=False):
         """Update the device."""
-        _LOGGER.debug("Updating device: '%s'", self.name)
         if force:
-            self._controller._update()
+            await self._controller.async_refresh()
         else:
-            self._controller.update()
-        self._current_value = self._controller.get_data()
-        self._last_value = self._controller.get_last_data()
+            self._update_from_controller()
+
+    def _value(self):
+        """Return the current value of the key."""
+        return self._controller.get_value(self._api_key)
+
+    @callback
+    def _async_handle_update(self):
+        """Handle new data pushed by the controller."""
+        self._update_from_controller()
+        self.async_write_ha_state()
+
+    @property
+    def device_state_attributes(self):
+        """Return the state attributes of the device."""
+        return {"stale": self._controller.is_stale()}
+
+    def _update_from_controller(self):
+        """Read the latest data from the controller."""
+        _LOGGER.debug("Updating device: '%s'", self.name)
         self._is_online = self._controller.is_online()
 
         if self._is_online:
@@ -265,11 +974,15 @@ class TeslaFiDevice(Entity):
 
     async def async_added_to_hass(self):
         """Register state update callback."""
-        pass
+        self._unsub_listener = self._controller.async_add_listener(
+            self._async_handle_update, (self._api_key, KEY_ONLINE, KEY_STALE)
+        )
 
     async def async_will_remove_from_hass(self):
         """Prepare for unload."""
-        pass
+        if self._unsub_listener is not None:
+            self._unsub_listener()
+            self._unsub_listener = None
 
 """=================================================================================================================="""
 
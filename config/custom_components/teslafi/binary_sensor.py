@@ -3,7 +3,8 @@ import logging
 from homeassistant.helpers.entity import Entity
 from homeassistant.components.binary_sensor import BinarySensorDevice
 
-from . import DOMAIN, TeslaFi, TeslaFiDevice
+from . import CONF_DISCOVER_FIELDS, CONF_FIELDS, DOMAIN, TeslaFi, TeslaFiDevice
+from .catalogue import PLATFORM_BINARY_SENSOR, TeslaFiMaterializer, compile_predicate
 
 """=================================================================================================================="""
 
@@ -18,16 +19,20 @@ async def async_setup_platform(hass, config, add_entities, discovery_info=None):
     if discovery_info is None:
         return
 
-    controller = hass.data[DOMAIN]["controller"]
+    config = hass.data[DOMAIN]["config"]
 
-    devices = []
-    devices.append(TeslaFiBinarySensor(controller, '_status', 'power', 'state', 'online'))
-    devices.append(TeslaFiBinarySensor(controller, '_charge_enable', None, 'charge_enable_request', '1'))
-    devices.append(TeslaFiBinarySensor(controller, '_climate', None, 'is_climate_on', '1'))
-#    devices.append(TeslaFiBinarySensor(controller, '_locked', 'lock', 'locked', 'False'))
-    devices.append(TeslaFiBinarySensor(controller, '_charge_plug', 'plug', 'charging_state', 'Disconnected', False))   # 'charge_port_latch':'Engaged'
+    for controller in hass.data[DOMAIN]["controllers"]:
+        TeslaFiMaterializer(
+            controller, PLATFORM_BINARY_SENSOR, config.get(CONF_FIELDS), config.get(CONF_DISCOVER_FIELDS),
+            _create_binary_sensor, add_entities,
+        ).async_start()
 
-    add_entities(devices, True)
+
+def _create_binary_sensor(controller, field):
+    """Create the binary sensor of a catalogue field."""
+    return TeslaFiBinarySensor(
+        controller, field.device_name, field.device_class, field.key, field.on_value, field.positive
+    )
 
 """=================================================================================================================="""
 
@@ -37,8 +42,7 @@ class TeslaFiBinarySensor(BinarySensorDevice, TeslaFiDevice):
     def __init__(self, controller, device_name, device_type, api_key, on_value, positive=True):
         """Initialize of the sensor."""
         super().__init__(controller, device_name, device_type, api_key, False)
-        self._on_value = on_value
-        self._positive = positive
+        self._is_on = compile_predicate(on_value, positive)
 
 
     @property
@@ -49,9 +53,6 @@ class TeslaFiBinarySensor(BinarySensorDevice, TeslaFiDevice):
     @property
     def is_on(self):
         """Return the state of the sensor."""
-        if self._positive:
-            return self._current_value[self._api_key] == self._on_value
-        else:
-            return self._current_value[self._api_key] != self._on_value
+        return self._is_on(self._value())
 
 """=================================================================================================================="""
@@ -0,0 +1,177 @@
+"""Declarative catalogue of the TeslaFi feed fields exposed as entities."""
+import logging
+
+from homeassistant.core import callback
+
+from .changes import KEY_FEED_KEYS
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+PLATFORM_SENSOR = "sensor"
+PLATFORM_BINARY_SENSOR = "binary_sensor"
+
+"""=================================================================================================================="""
+
+class TeslaFiField:
+    """Description of one feed field and of the entity exposing it"""
+
+    __slots__ = (
+        'key', 'platform', 'device_name', 'unit', 'device_class', 'on_value', 'positive',
+        'assume',
+    )
+
+    def __init__(self, key, platform, device_name=None, unit=None, device_class=None,
+                 on_value=True, positive=True, assume=False):
+        """Initialise the field; binary sensors are on when the value is (not, if not positive) on_value."""
+        self.key = key
+        self.platform = platform
+        self.device_name = device_name or f"_{key}"
+        self.unit = unit
+        self.device_class = device_class
+        self.on_value = on_value
+        self.positive = positive
+        self.assume = assume
+
+
+def compile_predicate(on_value, positive=True):
+    """Return the test of a binary sensor value, built once instead of at every state read."""
+    if positive:
+        return lambda value: value == on_value
+    return lambda value: value != on_value
+
+
+def _sensor(key, device_name=None, unit=None, device_class=None, assume=False):
+    return TeslaFiField(key, PLATFORM_SENSOR, device_name, unit, device_class, assume=assume)
+
+
+def _binary(key, device_name=None, device_class=None, on_value=True, positive=True):
+    return TeslaFiField(key, PLATFORM_BINARY_SENSOR, device_name, None, device_class, on_value, positive)
+
+
+CATALOGUE = (
+    # State
+    _sensor('carState', '_state'),
+    _sensor('Date', '_last_seen', assume=True),
+    _sensor('shift_state'),
+    _sensor('speed', unit='mph'),
+    _sensor('heading', unit='°'),
+    _sensor('power', unit='kW', device_class='power'),
+    _sensor('odometer', unit='mi', assume=True),
+    _sensor('car_version', assume=True),
+    _binary('state', '_status', 'power', 'online'),
+    _binary('locked', '_locked', 'lock', False),
+    _binary('sentry_mode', device_class='safety'),
+    _binary('valet_mode'),
+    _binary('is_user_present', device_class='occupancy'),
+    _binary('df', '_driver_front_door', 'door'),
+    _binary('dr', '_driver_rear_door', 'door'),
+    _binary('pf', '_passenger_front_door', 'door'),
+    _binary('pr', '_passenger_rear_door', 'door'),
+    _binary('ft', '_front_trunk', 'opening'),
+    _binary('rt', '_rear_trunk', 'opening'),
+    # Battery
+    _sensor('battery_level', unit='%', device_class='battery', assume=True),
+    _sensor('usable_battery_level', unit='%', device_class='battery', assume=True),
+    _sensor('battery_range', unit='mi', assume=True),
+    _sensor('est_battery_range', unit='mi', assume=True),
+    _sensor('ideal_battery_range', unit='mi', assume=True),
+    _binary('battery_heater_on', '_battery_heater', 'heat'),
+    # Charging
+    _sensor('charging_state'),
+    _sensor('charger_actual_current', '_charging_current', unit='A'),
+    _sensor('charger_voltage', unit='V'),
+    _sensor('charger_power', unit='kW', device_class='power'),
+    _sensor('charger_phases'),
+    _sensor('charge_energy_added', unit='kWh'),
+    _sensor('charge_rate', unit='mph'),
+    _sensor('charge_limit_soc', unit='%', assume=True),
+    _sensor('time_to_full_charge', unit='h'),
+    _sensor('fast_charger_type'),
+    _sensor('charge_port_latch'),
+    _binary('charge_enable_request', '_charge_enable'),
+    _binary('charging_state', '_charge_plug', 'plug', 'Disconnected', False),
+    _binary('charge_port_door_open', '_charge_port', 'opening'),
+    _binary('fast_charger_present'),
+    # Climate
+    _sensor('inside_temp', unit='°C', device_class='temperature'),
+    _sensor('outside_temp', unit='°C', device_class='temperature'),
+    _sensor('driver_temp_setting', unit='°C', device_class='temperature'),
+    _sensor('passenger_temp_setting', unit='°C', device_class='temperature'),
+    _binary('is_climate_on', '_climate'),
+    _binary('is_preconditioning'),
+    # Tires
+    _sensor('tpms_pressure_fl', unit='bar', device_class='pressure'),
+    _sensor('tpms_pressure_fr', unit='bar', device_class='pressure'),
+    _sensor('tpms_pressure_rl', unit='bar', device_class='pressure'),
+    _sensor('tpms_pressure_rr', unit='bar', device_class='pressure'),
+)
+
+# Entities created even before TeslaFi reports a value
+DEFAULT_FIELDS = [
+    'carState',
+    'Date',
+    'state',
+    'charging_state',
+    'charger_actual_current',
+    'charge_energy_added',
+    'charge_enable_request',
+    'is_climate_on',
+    'battery_level',
+    'usable_battery_level',
+]
+
+CATALOGUE_KEYS = tuple(dict.fromkeys(field.key for field in CATALOGUE))
+
+"""=================================================================================================================="""
+
+class TeslaFiMaterializer:
+    """Create the entities of a platform lazily: enabled fields at once, others once valued in the feed"""
+
+    def __init__(self, controller, platform, enabled, discover, factory, add_entities):
+        """Initialise the materializer.
+
+        factory: builds the entity of a field for the controller.
+        """
+        self._controller = controller
+        self._factory = factory
+        self._add_entities = add_entities
+        self._unsub = None
+
+        fields = [field for field in CATALOGUE if field.platform == platform]
+        self._ready = [field for field in fields if field.key in enabled]
+        self._pending = [field for field in fields if discover and field.key not in enabled]
+
+    def _has_value(self, field):
+        """Return True if the field is valued in the whole feed, or in the restored data."""
+        feed_keys = self._controller.feed_keys
+        if feed_keys is not None:
+            return field.key in feed_keys
+        return self._controller.get_last_value(field.key) is not None
+
+    @callback
+    def async_start(self):
+        """Add the enabled entities and those already valued, then wait for the feed keys."""
+        ready = self._ready + [field for field in self._pending if self._has_value(field)]
+        self._pending = [field for field in self._pending if field not in ready]
+        self._add_entities([self._factory(self._controller, field) for field in ready], True)
+
+        # Only the created entities project their keys, not every pending field
+        if self._pending and self._controller.feed_keys is None:
+            self._unsub = self._controller.async_add_listener(self._async_check_pending, (KEY_FEED_KEYS,))
+
+    @callback
+    def _async_check_pending(self):
+        """Add the entities of the fields valued in the feed, once it is known."""
+        if self._controller.feed_keys is None:
+            return
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+        ready = [field for field in self._pending if self._has_value(field)]
+        self._pending = []
+        if not ready:
+            return
+        _LOGGER.debug("Adding TeslaFi entities: %s", [field.key for field in ready])
+        self._add_entities([self._factory(self._controller, field) for field in ready], True)
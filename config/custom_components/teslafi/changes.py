@@ -0,0 +1,68 @@
+"""Change-set computation between consecutive TeslaFi snapshots."""
+import logging
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+# Pseudo-key reported when the vehicle goes online or offline
+KEY_ONLINE = "_online"
+# Pseudo-key reported when the data becomes stale or fresh again
+KEY_STALE = "_stale"
+# Pseudo-key reported when a charging session starts or finishes
+KEY_CHARGING_SESSION = "_charging_session"
+# Pseudo-key reported when a trip finishes
+KEY_TRIP = "_trip"
+# Pseudo-key reported after each poll when the metrics are enabled
+KEY_METRICS = "_metrics"
+# Pseudo-key reported once the keys of the whole feed are known
+KEY_FEED_KEYS = "_feed_keys"
+
+"""=================================================================================================================="""
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TeslaFiChangeDetector:
+    """Compute the keys whose value changed since the last published snapshot"""
+
+    def __init__(self, deadbands=None):
+        """Initialise the detector with optional per-key numeric deadbands."""
+        self._deadbands = dict(deadbands or {})
+        self._reference = {}
+        self._online = None
+
+    def diff(self, data, online):
+        """Return the set of changed keys and remember the published values."""
+        data = data or {}
+        changes = set()
+
+        if online != self._online:
+            changes.add(KEY_ONLINE)
+            self._online = online
+
+        for key in set(self._reference).union(data):
+            new = data.get(key)
+            old = self._reference.get(key)
+            if new == old:
+                continue
+
+            deadband = self._deadbands.get(key)
+            if deadband is not None:
+                new_f = _to_float(new)
+                old_f = _to_float(old)
+                # Keep the old reference so slow drifts are still reported
+                if new_f is not None and old_f is not None and abs(new_f - old_f) <= deadband:
+                    continue
+
+            changes.add(key)
+            if new is None:
+                self._reference.pop(key, None)
+            else:
+                self._reference[key] = new
+
+        return changes
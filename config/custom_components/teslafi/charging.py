@@ -0,0 +1,193 @@
+"""Incremental charging session detection for TeslaFi vehicles."""
+import logging
+import os
+import struct
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+# Keys the detector needs in the snapshot
+CHARGING_KEYS = (
+    'charging_state',
+    'charge_energy_added',
+    'charger_actual_current',
+    'charger_power',
+    'battery_level',
+)
+
+CHARGING_STATE_CHARGING = 'Charging'
+
+# start, end (epoch seconds), energy added (kWh), peak current (A), mean current (A),
+# peak power (kW), battery level at start and end (%)
+RECORD = struct.Struct('<ddffffBB')
+
+"""=================================================================================================================="""
+
+class TeslaFiChargingSession:
+    """Running aggregates of one charging session, in constant memory"""
+
+    __slots__ = (
+        'start', 'end', 'energy_added', 'peak_current', 'peak_power',
+        'start_battery_level', 'end_battery_level', '_current_sum', '_samples',
+    )
+
+    def __init__(self, start, battery_level=None):
+        """Start a session at a timestamp."""
+        self.start = start
+        self.end = start
+        self.energy_added = 0.0
+        self.peak_current = 0.0
+        self.peak_power = 0.0
+        self.start_battery_level = battery_level
+        self.end_battery_level = battery_level
+        self._current_sum = 0.0
+        self._samples = 0
+
+    @property
+    def duration(self):
+        """Return the duration in seconds."""
+        return self.end - self.start
+
+    @property
+    def mean_current(self):
+        """Return the mean charging current."""
+        return self._current_sum / self._samples if self._samples else 0.0
+
+    def add(self, snapshot, timestamp):
+        """Aggregate one snapshot."""
+        self.end = timestamp
+        energy = snapshot['charge_energy_added']
+        if energy is not None:
+            # Cumulative over the session as reported by the vehicle
+            self.energy_added = max(self.energy_added, energy)
+        current = snapshot['charger_actual_current']
+        if current is not None:
+            self.peak_current = max(self.peak_current, current)
+            self._current_sum += current
+            self._samples += 1
+        power = snapshot['charger_power']
+        if power is not None:
+            self.peak_power = max(self.peak_power, power)
+        level = snapshot['battery_level']
+        if level is not None:
+            if self.start_battery_level is None:
+                self.start_battery_level = level
+            self.end_battery_level = level
+
+    def as_dict(self):
+        """Return the session as a dict."""
+        return {
+            'start': self.start,
+            'end': self.end,
+            'duration': self.duration,
+            'energy_added': round(self.energy_added, 2),
+            'peak_current': self.peak_current,
+            'mean_current': round(self.mean_current, 1),
+            'peak_power': self.peak_power,
+            'start_battery_level': self.start_battery_level,
+            'end_battery_level': self.end_battery_level,
+        }
+
+    def pack(self):
+        """Return the session as a fixed-size binary record."""
+        return RECORD.pack(
+            self.start, self.end, self.energy_added, self.peak_current, self.mean_current,
+            self.peak_power, self.start_battery_level or 0, self.end_battery_level or 0,
+        )
+
+    @classmethod
+    def unpack(cls, record):
+        """Build a finished session from a binary record."""
+        start, end, energy, peak_current, mean_current, peak_power, start_level, end_level = \
+            RECORD.unpack(record)
+        session = cls(start, start_level)
+        session.end = end
+        session.energy_added = energy
+        session.peak_current = peak_current
+        session.peak_power = peak_power
+        session.end_battery_level = end_level
+        session._current_sum = mean_current
+        session._samples = 1
+        return session
+
+"""=================================================================================================================="""
+
+class TeslaFiSessionLog:
+    """Append-only log of finished sessions, one fixed-size record each"""
+
+    def __init__(self, path):
+        """Initialise the log stored at path."""
+        self._path = path
+
+    def append(self, session):
+        """Append a finished session. Blocking, run it in the executor."""
+        with open(self._path, 'ab') as log:
+            log.write(session.pack())
+
+    def read(self, count=None):
+        """Return the last count sessions (all if None), oldest first. Blocking."""
+        try:
+            with open(self._path, 'rb') as log:
+                size = log.seek(0, os.SEEK_END)
+                # Ignore a partially written last record
+                records = size // RECORD.size
+                first = 0 if count is None else max(0, records - count)
+                log.seek(first * RECORD.size)
+                data = log.read((records - first) * RECORD.size)
+        except FileNotFoundError:
+            return []
+        return [
+            TeslaFiChargingSession.unpack(data[offset:offset + RECORD.size])
+            for offset in range(0, len(data), RECORD.size)
+        ]
+
+"""=================================================================================================================="""
+
+class TeslaFiChargingTracker:
+    """Detect charging sessions from the snapshot stream"""
+
+    def __init__(self):
+        """Initialise the tracker."""
+        self.current = None
+        self.last = None
+
+    def update(self, snapshot, timestamp):
+        """Feed a snapshot. Returns the session finished by it, or None."""
+        if snapshot is None:
+            return None
+
+        charging = snapshot['charging_state'] == CHARGING_STATE_CHARGING
+        if charging:
+            if self.current is None:
+                _LOGGER.debug("Charging session started")
+                self.current = TeslaFiChargingSession(timestamp, snapshot['battery_level'])
+            self.current.add(snapshot, timestamp)
+            return None
+
+        if self.current is None:
+            return None
+
+        finished = self.current
+        finished.end = timestamp
+        energy = snapshot['charge_energy_added']
+        if energy is not None:
+            finished.energy_added = max(finished.energy_added, energy)
+        return self._finish()
+
+    def interrupt(self):
+        """Finish the current session at its last snapshot, the vehicle went offline or stale.
+
+        Returns the session finished, or None.
+        """
+        if self.current is None:
+            return None
+        _LOGGER.debug("Charging session interrupted")
+        return self._finish()
+
+    def _finish(self):
+        finished = self.current
+        self.current = None
+        self.last = finished
+        _LOGGER.debug("Charging session finished: %s", finished.as_dict())
+        return finished
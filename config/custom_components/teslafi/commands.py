@@ -0,0 +1,169 @@
+"""Command queue for the TeslaFi controller."""
+from collections import OrderedDict
+import asyncio
+import logging
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+COMMAND_WAKE_UP = 'wake_up'
+
+# Commands of the same group contradict each other: only the last one is sent
+COMMAND_GROUPS = {
+    'wake_up': 'wake',
+    'door_lock': 'doors',
+    'door_unlock': 'doors',
+    'charge_start': 'charge',
+    'charge_stop': 'charge',
+    'auto_conditioning_start': 'climate',
+    'auto_conditioning_stop': 'climate',
+    'charge_port_door_open': 'charge_port',
+    'charge_port_door_close': 'charge_port',
+    'set_charge_limit': 'charge_limit',
+    'set_sentry_mode': 'sentry_mode',
+}
+
+# Wait for a burst of commands to settle before draining the queue
+COALESCE_DELAY = 0.5
+COMMAND_RETRIES = 3
+COMMAND_BACKOFF = 2
+# Refresh once after the queue is drained, leaving time to the vehicle to apply the commands
+REFRESH_DELAY = 5
+
+RETRYABLE_REASONS = ('unavailable', 'timeout', 'timed out', 'asleep', 'offline')
+
+"""=================================================================================================================="""
+
+def command_group(command):
+    """Return the coalescing group of a command (parameters excluded)."""
+    name = command.split('&', 1)[0]
+    return COMMAND_GROUPS.get(name, name)
+
+
+def _is_retryable(result):
+    """Return True if a command response reports a transient failure."""
+    if result is None:
+        return True
+    try:
+        response = result['response']
+        if response.get('result', True):
+            return False
+        reason = str(response.get('reason', '')).lower()
+    except (AttributeError, KeyError, TypeError):
+        return False
+    return any(retryable in reason for retryable in RETRYABLE_REASONS)
+
+
+def _has_failed(result):
+    """Return True if a command got no response, or a response reporting a failure."""
+    if result is None:
+        return True
+    try:
+        return not result['response'].get('result', True)
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+"""=================================================================================================================="""
+
+class TeslaFiCommandQueue:
+    """Coalescing command queue, waking the vehicle once per batch"""
+
+    def __init__(self, hass, send, is_online, request_refresh):
+        """Initialise the queue.
+
+        send: coroutine sending a command right away, returning the response or None.
+        is_online: returns True if the vehicle is awake.
+        request_refresh: schedules a refresh of the vehicle data after a delay.
+        """
+        self._hass = hass
+        self._send = send
+        self._is_online = is_online
+        self._request_refresh = request_refresh
+        self._pending = OrderedDict()
+        self._task = None
+
+    async def async_send(self, command):
+        """Queue a command, returning its response (None if superseded or failed)."""
+        future = self._hass.loop.create_future()
+        group = command_group(command)
+        futures = [future]
+
+        previous = self._pending.get(group)
+        if previous is not None:
+            if previous[0] == command:
+                futures = previous[1] + futures
+            else:
+                _LOGGER.debug("TeslaFi command %s superseded by %s", previous[0], command)
+                self._resolve(previous[1], None)
+
+        # Replaced in place: the group keeps its position in the queue
+        self._pending[group] = (command, futures)
+
+        if self._task is None:
+            self._task = self._hass.async_create_task(self._async_drain())
+
+        return await future
+
+    @staticmethod
+    def _resolve(futures, result):
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _async_drain(self):
+        """Send the pending commands in order, waking the vehicle first if needed."""
+        futures = []
+        try:
+            await asyncio.sleep(COALESCE_DELAY)
+            awake = self._is_online()
+            # Response of the wake up sent by the drain, answering a queued wake up
+            woken = None
+
+            while self._pending:
+                _, (command, futures) = self._pending.popitem(last=False)
+
+                if awake and command == COMMAND_WAKE_UP:
+                    # Already awake: a single wake up per batch
+                    self._resolve(futures, woken)
+                    continue
+                if not awake:
+                    _LOGGER.debug("Waking up the vehicle before sending the commands")
+                    woken = await self._async_send_with_retry(COMMAND_WAKE_UP)
+                    if _has_failed(woken):
+                        # Not sent to a sleeping vehicle: the commands fail like the wake up
+                        self._resolve(futures, woken)
+                        for _, pending in self._pending.values():
+                            self._resolve(pending, woken)
+                        self._pending.clear()
+                        break
+                    awake = True
+                    if command == COMMAND_WAKE_UP:
+                        self._resolve(futures, woken)
+                        continue
+
+                result = await self._async_send_with_retry(command)
+                self._resolve(futures, result)
+        finally:
+            # Nothing is left unanswered if the drain is cancelled
+            self._resolve(futures, None)
+            for _, pending in self._pending.values():
+                self._resolve(pending, None)
+            self._pending.clear()
+            self._task = None
+
+        self._request_refresh(REFRESH_DELAY)
+
+    async def _async_send_with_retry(self, command):
+        """Send a command, retrying transient failures with an exponential backoff."""
+        result = None
+        for attempt in range(COMMAND_RETRIES + 1):
+            result = await self._send(command)
+            if not _is_retryable(result):
+                return result
+            if attempt < COMMAND_RETRIES:
+                delay = COMMAND_BACKOFF * 2 ** attempt
+                _LOGGER.debug("TeslaFi command %s failed, retrying in %ss", command, delay)
+                await asyncio.sleep(delay)
+        _LOGGER.warning("TeslaFi command %s failed after %s attempts", command, COMMAND_RETRIES + 1)
+        return result
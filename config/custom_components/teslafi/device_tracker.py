@@ -1,51 +1,94 @@
 """Support for tracking Tesla cars."""
 import logging
 
-from homeassistant.helpers.event import async_track_utc_time_change
+from homeassistant.core import callback
 from homeassistant.util import slugify
 
-from . import DOMAIN, TeslaFi, TeslaFiDevice
+from . import CONF_MIN_DISTANCE, CONF_MIN_HEADING, DOMAIN, TeslaFi, TeslaFiDevice
+from .changes import KEY_ONLINE
+from .geo import distance, heading_delta
 
 _LOGGER = logging.getLogger(__name__)
 
 
 async def async_setup_scanner(hass, config, async_see, discovery_info=None):
     """Set up the TeslaFi tracker."""
-    tracker = TeslaFiDeviceTracker(
-        hass, config, async_see, hass.data[DOMAIN]["controller"]
-    )
-    await tracker.update_info()
-    async_track_utc_time_change(hass, tracker.update_info, second=range(0, 60, 30))
+    options = hass.data[DOMAIN]["config"]
+    for controller in hass.data[DOMAIN]["controllers"]:
+        tracker = TeslaFiDeviceTracker(hass, options, async_see, controller, hass.data[DOMAIN]["zones"])
+        await tracker.update_info()
+        tracker.async_start()
     return True
 
 
 class TeslaFiDeviceTracker:
     """A class representing a TeslaFi device tracker."""
 
-    def __init__(self, hass, config, see, controller):
+    def __init__(self, hass, config, see, controller, zones):
         """Initialize the TeslaFi device scanner."""
         self.hass = hass
         self.see = see
         self._controller = controller
+        self._zones = zones
         self._name = f"teslafi_{self._controller.name()}"
         self._uid = f"teslafi_{self._controller.uniq_name()}"
         self._device_name = "_device_tracker"
 
+        self._min_distance = config[CONF_MIN_DISTANCE]
+        self._min_heading = config[CONF_MIN_HEADING]
+        self._sent = None
+
+    @callback
+    def async_start(self):
+        """Follow the position pushed by the controller."""
+        self._controller.async_add_listener(
+            self._async_handle_update,
+            ('latitude', 'longitude', 'heading', KEY_ONLINE),
+        )
+
+    @callback
+    def _async_handle_update(self):
+        """Handle new data pushed by the controller."""
+        self.hass.async_create_task(self.update_info())
+
+    def _has_moved(self, lat, lon, heading):
+        """Return True if the position moved enough to be sent."""
+        if self._sent is None:
+            return True
+        sent_lat, sent_lon, sent_heading = self._sent
+        if distance(sent_lat, sent_lon, lat, lon) >= self._min_distance:
+            return True
+        return (heading is not None and sent_heading is not None
+                and heading_delta(sent_heading, heading) >= self._min_heading)
+
     async def update_info(self, now=None):
         """Update the device info."""
-        self._controller.update()
-    
         if self.available:
+            data = self._controller.get_data()
+            lat = data['latitude']
+            lon = data['longitude']
+            heading = data['heading']
+            if lat is None or lon is None:
+                return
+
+            if not self._has_moved(lat, lon, heading):
+                return
+
             name = self.name
             dev_id = self.unique_id
             _LOGGER.debug("Updating device position: %s", name)
-    
-            lat = self._controller.get_data()['latitude']
-            lon = self._controller.get_data()['longitude']
+
+            # The trip polylines stay in the trip store, see the query_trips service
             attrs = {"trackr_id": dev_id, "id": dev_id, "name": name}
+            # Resolved from the zone index, Home Assistant skips its scan of all the zones
             await self.see(
-                dev_id=dev_id, host_name=name, gps=(lat, lon), attributes=attrs
+                dev_id=dev_id,
+                host_name=name,
+                gps=(lat, lon),
+                location_name=self._zones.zone(lat, lon),
+                attributes=attrs,
             )
+            self._sent = (lat, lon, heading)
 
     @property
     def name(self):
@@ -60,7 +103,7 @@ class TeslaFiDeviceTracker:
     @property
     def should_poll(self):
         """Return the polling state."""
-        return True
+        return False
 
     @property
     def available(self):
@@ -0,0 +1,140 @@
+"""Geographic helpers for the TeslaFi tracker."""
+import math
+
+"""=================================================================================================================="""
+
+EARTH_RADIUS = 6371008.8
+
+# Points buffered before being simplified
+COMPRESSION_WINDOW = 64
+
+"""=================================================================================================================="""
+
+def distance(lat1, lon1, lat2, lon2):
+    """Return the great-circle distance in meters between two points."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def heading_delta(heading1, heading2):
+    """Return the smallest angle in degrees between two headings."""
+    delta = abs(heading1 - heading2) % 360
+    return 360 - delta if delta > 180 else delta
+
+
+def _segment_distance(point, start, end):
+    """Return the distance in meters from a point to a segment (local flat projection)."""
+    scale = math.cos(math.radians(start[0]))
+    px = (point[1] - start[1]) * scale
+    py = point[0] - start[0]
+    ex = (end[1] - start[1]) * scale
+    ey = end[0] - start[0]
+    length = ex * ex + ey * ey
+    if length:
+        t = max(0.0, min(1.0, (px * ex + py * ey) / length))
+        px -= t * ex
+        py -= t * ey
+    return math.radians(math.hypot(px, py)) * EARTH_RADIUS
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a list of (lat, lon), tolerance in meters."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, index = 0.0, None
+        for i in range(first + 1, last):
+            dist = _segment_distance(points[i], points[first], points[last])
+            if dist > farthest:
+                farthest, index = dist, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+"""=================================================================================================================="""
+
+class PolylineEncoder:
+    """Incremental encoder of the Google encoded polyline format"""
+
+    __slots__ = ('_chunks', '_lat', '_lon', 'count')
+
+    def __init__(self):
+        self._chunks = []
+        self._lat = 0
+        self._lon = 0
+        self.count = 0
+
+    @staticmethod
+    def _encode(value):
+        value = ~(value << 1) if value < 0 else value << 1
+        chunk = []
+        while value >= 0x20:
+            chunk.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunk.append(chr(value + 63))
+        return ''.join(chunk)
+
+    def add(self, lat, lon):
+        """Append a point."""
+        lat = int(round(lat * 1e5))
+        lon = int(round(lon * 1e5))
+        self._chunks.append(self._encode(lat - self._lat) + self._encode(lon - self._lon))
+        self._lat = lat
+        self._lon = lon
+        self.count += 1
+
+    @property
+    def value(self):
+        """Return the encoded polyline."""
+        return ''.join(self._chunks)
+
+"""=================================================================================================================="""
+
+class TrajectoryCompressor:
+    """Online Douglas-Peucker compression of a trace into an encoded polyline
+
+    Points are buffered in a bounded window; when it is full the window is simplified,
+    the kept points are encoded and the last one anchors the next window.
+    """
+
+    def __init__(self, tolerance, window=COMPRESSION_WINDOW):
+        """Initialise the compressor, tolerance in meters."""
+        self._tolerance = tolerance
+        self._window = window
+        self._buffer = []
+        self._encoder = PolylineEncoder()
+
+    @property
+    def count(self):
+        """Return the number of points kept so far."""
+        return self._encoder.count + len(self._buffer)
+
+    def add(self, lat, lon):
+        """Add a point of the trace."""
+        if self._buffer and self._buffer[-1] == (lat, lon):
+            return
+        self._buffer.append((lat, lon))
+        if len(self._buffer) >= self._window:
+            self._flush(keep_last=True)
+
+    def _flush(self, keep_last):
+        kept = simplify(self._buffer, self._tolerance)
+        anchor = kept.pop() if keep_last else None
+        for lat, lon in kept:
+            self._encoder.add(lat, lon)
+        self._buffer = [anchor] if anchor is not None else []
+
+    def finish(self):
+        """Return the encoded polyline of the whole trace."""
+        self._flush(keep_last=False)
+        return self._encoder.value
@@ -18,10 +18,9 @@ async def async_setup_platform(hass, config, add_entities, discovery_info=None):
     if discovery_info is None:
         return
 
-    controller = hass.data[DOMAIN]["controller"]
-
     devices = []
-    devices.append(TeslaFiLock(controller, '_door_lock', 'lock', 'locked', 'True'))
+    for controller in hass.data[DOMAIN]["controllers"]:
+        devices.append(TeslaFiLock(controller, '_door_lock', 'lock', 'locked', True))
 
     add_entities(devices, True)
 
@@ -51,7 +50,7 @@ class TeslaFiLock(LockDevice, TeslaFiDevice):
             return "mdi:lock-open"
 
 
-    def _execute(self, lock):
+    async def _async_execute(self, lock):
         """Send the lock / unlock command."""
         command = None
         rety = None
@@ -59,32 +58,35 @@ class TeslaFiLock(LockDevice, TeslaFiDevice):
         if lock:
             command = 'door_lock'
             rety = self._on_value
-            retn = '!' + self._on_value
+            retn = not self._on_value
         else:
             command = 'door_unlock'
-            rety = '!' + self._on_value
+            rety = not self._on_value
             retn = self._on_value
-        res = self._controller.send(command)
+        res = await self._controller.async_send(command)
+        if res is None:
+            # Superseded or failed, the refresh after the commands tells the state
+            return
         # Overrides buffer with response (valid until next polling)
         if res['response']['result']:
-            self._current_value[self._api_key] = rety
+            self._controller.async_set_optimistic(self._api_key, rety)
         else:
-            self._current_value[self._api_key] = retn
+            self._controller.async_set_optimistic(self._api_key, retn)
 
 
-    def lock(self, **kwargs):
+    async def async_lock(self, **kwargs):
         _LOGGER.debug("Locking doors for: %s", self.name)
-        self._execute(True)
+        await self._async_execute(True)
 
 
-    def unlock(self, **kwargs):
+    async def async_unlock(self, **kwargs):
         _LOGGER.debug("Unlocking doors for: %s", self.name)
-        self._execute(False)
+        await self._async_execute(False)
 
 
     @property
     def is_locked(self):
         """Get whether the lock is in locked state."""
-        return self._current_value[self._api_key] == self._on_value
+        return self._value() == self._on_value
 
 """=================================================================================================================="""
@@ -0,0 +1,143 @@
+"""Low overhead metrics of the TeslaFi controller hot paths."""
+from bisect import bisect_left
+import logging
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+ENDPOINT_CURRENT = "current"
+ENDPOINT_LAST_GOOD = "lastGood"
+ENDPOINT_COMMAND = "command"
+
+# Upper bounds of the histogram buckets, in milliseconds
+LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+
+"""=================================================================================================================="""
+
+class Histogram:
+    """Fixed buckets histogram: O(log buckets) per sample, constant memory"""
+
+    __slots__ = ('_bounds', '_counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds):
+        """Initialise the histogram with the upper bounds of its buckets."""
+        self._bounds = bounds
+        # The last bucket counts what exceeds the last bound
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Record a sample."""
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        """Return the mean of the samples, None if empty."""
+        return self.total / self.count if self.count else None
+
+    def percentile(self, share):
+        """Return the upper bound of the bucket holding a share (0..1) of the samples."""
+        if not self.count:
+            return None
+        rank = share * self.count
+        seen = 0
+        for bound, count in zip(self._bounds, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Return a summary of the histogram."""
+        mean = self.mean
+        return {
+            'count': self.count,
+            'mean': None if mean is None else round(mean, 2),
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': round(self.max, 2),
+            'buckets': dict(zip([str(bound) for bound in self._bounds] + ['inf'], self._counts)),
+        }
+
+"""=================================================================================================================="""
+
+class TeslaFiMetrics:
+    """Counters and histograms of one controller"""
+
+    def __init__(self):
+        """Initialise the metrics."""
+        self.latency = {
+            endpoint: Histogram(LATENCY_BUCKETS)
+            for endpoint in (ENDPOINT_CURRENT, ENDPOINT_LAST_GOOD, ENDPOINT_COMMAND)
+        }
+        self.parse_time = Histogram(DURATION_BUCKETS)
+        self.fan_out_time = Histogram(DURATION_BUCKETS)
+        self.bytes_received = 0
+        self.requests = 0
+        self.failures = 0
+        # Conditional requests answered from the last snapshot (hit) or parsed again (miss)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.online_transitions = 0
+        self.offline_transitions = 0
+
+    def record_request(self, endpoint, seconds, success):
+        """Record the latency of a request to an endpoint."""
+        self.latency[endpoint].add(seconds * 1000)
+        self.requests += 1
+        if not success:
+            self.failures += 1
+
+    def record_response(self, size, parse_seconds=None):
+        """Record the size of a response body and the time spent decoding it."""
+        self.bytes_received += size
+        if parse_seconds is not None:
+            self.parse_time.add(parse_seconds * 1000)
+
+    def record_cache(self, hit):
+        """Record a conditional request served from the cache, or not."""
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def record_transition(self, online):
+        """Record the vehicle going online or offline."""
+        if online:
+            self.online_transitions += 1
+        else:
+            self.offline_transitions += 1
+
+    def record_fan_out(self, seconds):
+        """Record the time spent notifying the entities of a change."""
+        self.fan_out_time.add(seconds * 1000)
+
+    @property
+    def cache_hit_ratio(self):
+        """Return the share of conditional requests served from the cache, in %."""
+        total = self.cache_hits + self.cache_misses
+        return round(100 * self.cache_hits / total, 1) if total else None
+
+    def as_dict(self):
+        """Return all the metrics; times in milliseconds."""
+        return {
+            'latency': {endpoint: histogram.as_dict() for endpoint, histogram in self.latency.items()},
+            'parse_time': self.parse_time.as_dict(),
+            'fan_out_time': self.fan_out_time.as_dict(),
+            'bytes_received': self.bytes_received,
+            'requests': self.requests,
+            'failures': self.failures,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_hit_ratio': self.cache_hit_ratio,
+            'online_transitions': self.online_transitions,
+            'offline_transitions': self.offline_transitions,
+        }
@@ -0,0 +1,72 @@
+"""Optimistic state overlay on top of the polled TeslaFi snapshot."""
+import logging
+import time
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TTL = 120
+
+"""=================================================================================================================="""
+
+class TeslaFiOverlay:
+    """Optimistic values with a time to live, read before the polled snapshot"""
+
+    __slots__ = ('_ttl', '_entries')
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """Initialise the overlay, ttl in seconds."""
+        self._ttl = ttl
+        # key -> (value, set at, expires at), monotonic times
+        self._entries = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    def set(self, key, value):
+        """Set an optimistic value."""
+        now = time.monotonic()
+        self._entries[key] = (value, now, now + self._ttl)
+
+    def get(self, key, default=None):
+        """Return the optimistic value of a key, or default."""
+        entry = self._entries.get(key)
+        return default if entry is None else entry[0]
+
+    def next_expiry(self):
+        """Return the monotonic time of the next expiry, or None."""
+        if not self._entries:
+            return None
+        return min(entry[2] for entry in self._entries.values())
+
+    def expire(self):
+        """Drop the expired values, returning their keys."""
+        now = time.monotonic()
+        expired = {key for key, entry in self._entries.items() if entry[2] <= now}
+        for key in expired:
+            del self._entries[key]
+        return expired
+
+    def reconcile(self, snapshot, fetched_at):
+        """Drop the values confirmed or contradicted by a snapshot fetched at a monotonic time.
+
+        A snapshot fetched before a value was set can neither confirm nor contradict it.
+        Returns the keys dropped.
+        """
+        if snapshot is None:
+            return set()
+        cleared = set()
+        for key, (value, set_at, _) in self._entries.items():
+            if snapshot[key] == value:
+                _LOGGER.debug("Optimistic %s confirmed by poll", key)
+                cleared.add(key)
+            elif fetched_at > set_at:
+                _LOGGER.debug("Optimistic %s contradicted by poll", key)
+                cleared.add(key)
+        for key in cleared:
+            del self._entries[key]
+        return cleared
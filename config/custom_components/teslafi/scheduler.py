@@ -0,0 +1,84 @@
+"""Adaptive polling interval for the TeslaFi controller."""
+from datetime import timedelta
+import logging
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+STATE_DRIVING = "driving"
+STATE_CHARGING = "charging"
+STATE_ONLINE = "online"
+STATE_ASLEEP = "asleep"
+STATE_OFFLINE = "offline"
+
+POLLING_STATES = [STATE_DRIVING, STATE_CHARGING, STATE_ONLINE, STATE_ASLEEP, STATE_OFFLINE]
+
+DEFAULT_INTERVALS = {
+    STATE_DRIVING: timedelta(seconds=15),
+    STATE_CHARGING: timedelta(seconds=30),
+    STATE_ONLINE: timedelta(seconds=60),
+    STATE_ASLEEP: timedelta(minutes=10),
+    STATE_OFFLINE: timedelta(minutes=15),
+}
+
+DRIVING_SHIFT_STATES = ("D", "R", "N")
+
+"""=================================================================================================================="""
+
+def vehicle_state(data, online):
+    """Return the polling state of the vehicle from the last fetched data."""
+    if not data:
+        return STATE_OFFLINE
+
+    if not online:
+        if data.get('state') == 'asleep' or data.get('carState') == 'Sleeping':
+            return STATE_ASLEEP
+        return STATE_OFFLINE
+
+    speed = data.get('speed')
+    if (data.get('carState') == 'Driving'
+            or data.get('shift_state') in DRIVING_SHIFT_STATES
+            or speed not in (None, '', '0', 0)):
+        return STATE_DRIVING
+
+    if data.get('charging_state') == 'Charging' or data.get('carState') == 'Charging':
+        return STATE_CHARGING
+
+    if data.get('state') == 'asleep' or data.get('carState') == 'Sleeping':
+        return STATE_ASLEEP
+
+    return STATE_ONLINE
+
+"""=================================================================================================================="""
+
+class TeslaFiPollScheduler:
+    """Pick the next poll interval from the state of the vehicle"""
+
+    def __init__(self, intervals=None):
+        """Initialise the scheduler with the per-state intervals."""
+        self._intervals = dict(DEFAULT_INTERVALS)
+        self._intervals.update(intervals or {})
+        self._state = None
+
+    @property
+    def state(self):
+        """Return the state used for the last decision."""
+        return self._state
+
+    def interval(self, state):
+        """Return the poll interval configured for a state."""
+        return self._intervals[state]
+
+    def next_interval(self, data, online):
+        """Return the delay until the next poll."""
+        if not data:
+            # No poll succeeded yet: retry at the last known pace, as online at startup
+            state = self._state or STATE_ONLINE
+        else:
+            state = vehicle_state(data, online)
+        if state != self._state:
+            _LOGGER.debug("Polling state changed from %s to %s, next poll in %s",
+                          self._state, state, self._intervals[state])
+            self._state = state
+        return self._intervals[state]
@@ -1,13 +1,39 @@
 """Support for the Tesla sensors."""
 import logging
+from homeassistant.const import STATE_NOT_HOME
 from homeassistant.helpers.entity import Entity
 
-from . import DOMAIN, TeslaFi, TeslaFiDevice
+from . import CONF_DISCOVER_FIELDS, CONF_FIELDS, DOMAIN, TeslaFi, TeslaFiDevice
+from .catalogue import PLATFORM_SENSOR, TeslaFiMaterializer
+from .changes import KEY_CHARGING_SESSION, KEY_METRICS, KEY_ONLINE, KEY_STALE, KEY_TRIP
+from .metrics import ENDPOINT_CURRENT
 
 """=================================================================================================================="""
 
 _LOGGER = logging.getLogger(__name__)
 
+# device name, unit, icon, state and attributes from the controller metrics
+METRIC_SENSORS = (
+    ('_poll_latency', 'ms', 'mdi:timer',
+     lambda metrics: metrics.latency[ENDPOINT_CURRENT].percentile(0.95),
+     lambda metrics: {endpoint: histogram.as_dict() for endpoint, histogram in metrics.latency.items()}),
+    ('_bytes_received', 'kB', 'mdi:download',
+     lambda metrics: round(metrics.bytes_received / 1000, 1),
+     lambda metrics: {'requests': metrics.requests, 'failures': metrics.failures}),
+    ('_parse_time', 'ms', 'mdi:code-json',
+     lambda metrics: metrics.parse_time.percentile(0.95),
+     lambda metrics: metrics.parse_time.as_dict()),
+    ('_cache_hit_ratio', '%', 'mdi:cached',
+     lambda metrics: metrics.cache_hit_ratio,
+     lambda metrics: {'hits': metrics.cache_hits, 'misses': metrics.cache_misses}),
+    ('_fan_out_time', 'ms', 'mdi:call-split',
+     lambda metrics: metrics.fan_out_time.percentile(0.95),
+     lambda metrics: metrics.fan_out_time.as_dict()),
+    ('_online_transitions', None, 'mdi:swap-vertical',
+     lambda metrics: metrics.online_transitions + metrics.offline_transitions,
+     lambda metrics: {'online': metrics.online_transitions, 'offline': metrics.offline_transitions}),
+)
+
 """=================================================================================================================="""
 
 async def async_setup_platform(hass, config, add_entities, discovery_info=None):
@@ -17,22 +43,36 @@ async def async_setup_platform(hass, config, add_entities, discovery_info=None):
     if discovery_info is None:
         return
 
-    controller = hass.data[DOMAIN]["controller"]
+    config = hass.data[DOMAIN]["config"]
 
     devices = []
-    devices.append(TeslaFiSensor(controller, '_state', None, None, 'carState'))
-    devices.append(TeslaFiSensor(controller, '_location', None, None, 'location'))
-    devices.append(TeslaFiSensor(controller, '_charging_state', None, None, 'charging_state'))
-    devices.append(TeslaFiSensor(controller, '_charging_current', None, 'A', 'charger_actual_current'))
-    devices.append(TeslaFiSensor(controller, '_charge_energy_added', None, 'kWh', 'charge_energy_added'))
-    devices.append(TeslaFiSensor(controller, '_last_seen', None, None, 'Date', True))
-#    devices.append(TeslaFiSensor(controller, '_battery_heater', None, None, 'battery_heater'))
-#    devices.append(TeslaFiSensor(controller, '_battery_heater_on', None, None, 'battery_heater_on'))
-    devices.append(TeslaFiSensor(controller, '_battery_level', 'battery', '%', 'battery_level', True))
-    devices.append(TeslaFiSensor(controller, '_usable_battery_level', 'battery', '%', 'usable_battery_level', True))
+    for controller in hass.data[DOMAIN]["controllers"]:
+        # Plain feed fields come from the catalogue, created once they have a value
+        TeslaFiMaterializer(
+            controller, PLATFORM_SENSOR, config.get(CONF_FIELDS), config.get(CONF_DISCOVER_FIELDS),
+            _create_sensor, add_entities,
+        ).async_start()
+
+        devices.append(TeslaFiLocationSensor(controller, hass.data[DOMAIN]["zones"]))
+        devices.append(TeslaFiSummarySensor(controller, '_last_charge_energy_added', 'kWh', KEY_CHARGING_SESSION, 'last_charging_session', 'energy_added', 'mdi:ev-station'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_charge_duration', 'min', KEY_CHARGING_SESSION, 'last_charging_session', 'duration', 'mdi:ev-station'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_charge_peak_current', 'A', KEY_CHARGING_SESSION, 'last_charging_session', 'peak_current', 'mdi:ev-station'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_trip_distance', 'mi', KEY_TRIP, 'last_trip', 'distance', 'mdi:map-marker-distance'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_trip_duration', 'min', KEY_TRIP, 'last_trip', 'duration', 'mdi:map-marker-distance'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_trip_average_speed', 'mph', KEY_TRIP, 'last_trip', 'average_speed', 'mdi:speedometer'))
+        devices.append(TeslaFiSummarySensor(controller, '_last_trip_energy_used', 'kWh', KEY_TRIP, 'last_trip', 'energy_used', 'mdi:battery-minus'))
+
+        if controller.metrics is not None:
+            for device_name, unit, icon, state, attributes in METRIC_SENSORS:
+                devices.append(TeslaFiMetricSensor(controller, device_name, unit, icon, state, attributes))
 
     add_entities(devices, True)
 
+
+def _create_sensor(controller, field):
+    """Create the sensor of a catalogue field."""
+    return TeslaFiSensor(controller, field.device_name, field.device_class, field.unit, field.key, field.assume)
+
 """=================================================================================================================="""
 
 class TeslaFiSensor(TeslaFiDevice):
@@ -48,10 +88,10 @@ class TeslaFiSensor(TeslaFiDevice):
     def state(self):
         """Return the state of the sensor."""
         if self._is_online:
-            return self._current_value[self._api_key]
+            return self._value()
         else:
             if self._assume:
-                return self._last_value[self._api_key]
+                return self._controller.get_last_value(self._api_key)
             else:
                 return None
 
@@ -62,3 +102,133 @@ class TeslaFiSensor(TeslaFiDevice):
         return self._dclass
 
 """=================================================================================================================="""
+
+class TeslaFiLocationSensor(TeslaFiSensor):
+    """Representation of the location of a Tesla: zone, else place name."""
+
+    def __init__(self, controller, zones):
+        """Initialize of the sensor."""
+        super().__init__(controller, '_location', None, None, 'location')
+        self._zones = zones
+
+
+    async def async_added_to_hass(self):
+        """Register state update callback."""
+        self._unsub_listener = self._controller.async_add_listener(
+            self._async_handle_update, ('location', 'latitude', 'longitude', KEY_ONLINE, KEY_STALE)
+        )
+
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        if not self._is_online:
+            return None
+        lat = self._controller.get_value('latitude')
+        lon = self._controller.get_value('longitude')
+        location = self._value()
+        if lat is None or lon is None:
+            return location
+        zone = self._zones.zone(lat, lon)
+        if zone != STATE_NOT_HOME:
+            return zone
+        # TeslaFi does not always report the place name: the last one learned at this position
+        return location or self._zones.place(lat, lon)
+
+"""=================================================================================================================="""
+
+class TeslaFiSummarySensor(TeslaFiSensor):
+    """Representation of a value of the last charging session or trip of a Tesla."""
+
+    def __init__(self, controller, device_name, unit, api_key, summary, attribute, icon):
+        """Initialize of the sensor."""
+        super().__init__(controller, device_name, None, unit, api_key, True)
+        self._summary = summary
+        self._attribute = attribute
+        self._icon = icon
+
+
+    def _get_summary(self):
+        return getattr(self._controller, self._summary)
+
+
+    @property
+    def available(self):
+        """Return True once a summary was recorded."""
+        return self._get_summary() is not None
+
+
+    @property
+    def assumed_state(self):
+        """Return is the state was assumed."""
+        return False
+
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        summary = self._get_summary()
+        if summary is None or summary[self._attribute] is None:
+            return None
+        if self._unit == 'min':
+            return round(summary[self._attribute] / 60)
+        return summary[self._attribute]
+
+
+    @property
+    def device_state_attributes(self):
+        """Return the whole summary."""
+        summary = self._get_summary()
+        if summary is None:
+            return None
+        return {key: value for key, value in summary.items() if key != 'polyline'}
+
+
+    @property
+    def icon(self):
+        """Icon handling."""
+        return self._icon
+
+"""=================================================================================================================="""
+
+class TeslaFiMetricSensor(TeslaFiSensor):
+    """Diagnostic sensor of the controller metrics, updated after each poll."""
+
+    def __init__(self, controller, device_name, unit, icon, state, attributes):
+        """Initialize of the sensor."""
+        super().__init__(controller, device_name, None, unit, KEY_METRICS)
+        self._icon = icon
+        self._state = state
+        self._attributes = attributes
+
+
+    @property
+    def available(self):
+        """Return True, the metrics do not depend on the vehicle."""
+        return True
+
+
+    @property
+    def assumed_state(self):
+        """Return is the state was assumed."""
+        return False
+
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state(self._controller.metrics)
+
+
+    @property
+    def device_state_attributes(self):
+        """Return the details of the metric."""
+        return self._attributes(self._controller.metrics)
+
+
+    @property
+    def icon(self):
+        """Icon handling."""
+        return self._icon
+
+"""=================================================================================================================="""
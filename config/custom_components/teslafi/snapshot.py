@@ -0,0 +1,168 @@
+"""Compact typed snapshot of the TeslaFi feed."""
+import logging
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+# Keys always kept in a snapshot: vehicle identity and what the scheduler needs
+BASE_KEYS = (
+    'id',
+    'vehicle_id',
+    'display_name',
+    'vin',
+    'state',
+    'carState',
+    'charging_state',
+    'shift_state',
+    'speed',
+)
+
+"""=================================================================================================================="""
+
+def to_bool(value):
+    """Convert a TeslaFi flag ('1', '0', 'True', 'false', ...) to a bool."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('1', 'true', 'on', 'yes')
+
+
+def to_int(value):
+    """Convert a TeslaFi number to an int."""
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    """Convert a TeslaFi number to a float."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_str(value):
+    """Keep a TeslaFi value as a string."""
+    if value is None:
+        return None
+    return str(value)
+
+
+FIELD_TYPES = {
+    'battery_level': to_int,
+    'usable_battery_level': to_int,
+    'charge_limit_soc': to_int,
+    'charger_actual_current': to_float,
+    'charger_power': to_float,
+    'charger_voltage': to_float,
+    'charge_energy_added': to_float,
+    'charge_rate': to_float,
+    'battery_range': to_float,
+    'est_battery_range': to_float,
+    'ideal_battery_range': to_float,
+    'inside_temp': to_float,
+    'outside_temp': to_float,
+    'latitude': to_float,
+    'longitude': to_float,
+    'heading': to_float,
+    'speed': to_float,
+    'odometer': to_float,
+    'charge_enable_request': to_bool,
+    'is_climate_on': to_bool,
+    'locked': to_bool,
+    'battery_heater': to_bool,
+    'battery_heater_on': to_bool,
+    'sentry_mode': to_bool,
+    'valet_mode': to_bool,
+    'is_user_present': to_bool,
+    'is_preconditioning': to_bool,
+    'charge_port_door_open': to_bool,
+    'fast_charger_present': to_bool,
+    'df': to_bool,
+    'dr': to_bool,
+    'pf': to_bool,
+    'pr': to_bool,
+    'ft': to_bool,
+    'rt': to_bool,
+    'power': to_float,
+    'charger_phases': to_int,
+    'time_to_full_charge': to_float,
+    'driver_temp_setting': to_float,
+    'passenger_temp_setting': to_float,
+    'tpms_pressure_fl': to_float,
+    'tpms_pressure_fr': to_float,
+    'tpms_pressure_rl': to_float,
+    'tpms_pressure_rr': to_float,
+}
+
+def convert(key, value):
+    """Convert a raw feed value to the native type of its key."""
+    return FIELD_TYPES.get(key, to_str)(value)
+
+"""=================================================================================================================="""
+
+class TeslaFiSchema:
+    """Projection of the feed to the keys in use, with their converters"""
+
+    __slots__ = ('keys', 'index', '_converters')
+
+    def __init__(self, keys):
+        """Initialise the schema for the given keys."""
+        self.keys = tuple(dict.fromkeys(BASE_KEYS + tuple(keys)))
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self._converters = tuple(FIELD_TYPES.get(key, to_str) for key in self.keys)
+
+    def parse(self, raw):
+        """Build a snapshot from the decoded feed, converting every value once."""
+        if not isinstance(raw, dict):
+            return None
+        get = raw.get
+        return TeslaFiSnapshot(self, tuple(
+            convert(get(key)) for key, convert in zip(self.keys, self._converters)
+        ))
+
+"""=================================================================================================================="""
+
+class TeslaFiSnapshot:
+    """Immutable, typed values of one TeslaFi feed response"""
+
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        """Initialise the snapshot."""
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        index = self._schema.index.get(key)
+        return None if index is None else self._values[index]
+
+    def get(self, key, default=None):
+        """Return the value of a key."""
+        index = self._schema.index.get(key)
+        if index is None:
+            return default
+        value = self._values[index]
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    def items(self):
+        """Return the (key, value) pairs."""
+        return zip(self._schema.keys, self._values)
+
+    def as_dict(self):
+        """Return the values as a dict."""
+        return dict(self.items())
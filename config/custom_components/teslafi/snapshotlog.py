@@ -0,0 +1,210 @@
+"""Binary log of the TeslaFi snapshots, memory-mapped reader and replay source."""
+from array import array
+from bisect import bisect_right
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+
+from .transport import CircuitBreaker
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'TFSL1\n'
+# timestamp (epoch seconds), length of the JSON payload
+HEADER = struct.Struct('<dI')
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+DEFAULT_REPLAY_SPEED = 60
+
+"""=================================================================================================================="""
+
+class TeslaFiSnapshotLog:
+    """Append-only log of the projected snapshots, length-prefixed records, rotated by size
+
+    Blocking methods, run them in the executor.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        """Initialise the log at path; full files are renamed path.1 to path.<backups>."""
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+
+    def files(self):
+        """Return the existing files of the log, oldest first."""
+        paths = [f"{self._path}.{index}" for index in range(self._backups, 0, -1)] + [self._path]
+        return [path for path in paths if os.path.exists(path)]
+
+    def _rotate(self):
+        for index in range(self._backups - 1, 0, -1):
+            source = f"{self._path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self._path}.{index + 1}")
+        os.replace(self._path, f"{self._path}.1")
+
+    def append(self, timestamp, data):
+        """Append the snapshot (dict) taken at timestamp."""
+        payload = json.dumps(data, separators=(',', ':')).encode()
+        record = HEADER.pack(timestamp, len(payload)) + payload
+        try:
+            if os.path.getsize(self._path) + len(record) > self._max_bytes:
+                self._rotate()
+        except FileNotFoundError:
+            pass
+        with open(self._path, 'ab') as log:
+            if log.tell() == 0:
+                log.write(MAGIC)
+            log.write(record)
+
+"""=================================================================================================================="""
+
+class TeslaFiSnapshotReader:
+    """Memory-mapped reader of log files, with random access by timestamp
+
+    Only the record headers are read when opening; payloads stay in the mapped files
+    until decoded. Blocking methods, run them in the executor.
+    """
+
+    def __init__(self, paths):
+        """Initialise the reader of the given files, oldest first."""
+        self._paths = paths
+        self._maps = []
+        self._timestamps = array('d')
+        self._files = array('H')
+        self._offsets = array('Q')
+        self._lengths = array('I')
+
+    def open(self):
+        """Map the files and index their records."""
+        for path in self._paths:
+            with open(path, 'rb') as log:
+                if os.fstat(log.fileno()).st_size <= len(MAGIC):
+                    continue
+                mapped = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapped[:len(MAGIC)] != MAGIC:
+                _LOGGER.warning("Ignoring %s: not a TeslaFi snapshot log", path)
+                mapped.close()
+                continue
+            index = len(self._maps)
+            self._maps.append(mapped)
+            offset = len(MAGIC)
+            size = len(mapped)
+            while offset + HEADER.size <= size:
+                timestamp, length = HEADER.unpack_from(mapped, offset)
+                offset += HEADER.size
+                # Ignore a partially written last record
+                if offset + length > size:
+                    break
+                self._timestamps.append(timestamp)
+                self._files.append(index)
+                self._offsets.append(offset)
+                self._lengths.append(length)
+                offset += length
+        _LOGGER.debug("Indexed %s snapshots in %s files", len(self._timestamps), len(self._maps))
+
+    def close(self):
+        """Unmap the files."""
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def timestamp(self, index):
+        """Return the timestamp of a record."""
+        return self._timestamps[index]
+
+    def payload(self, index):
+        """Return the raw JSON payload of a record, without copying it."""
+        offset = self._offsets[index]
+        return memoryview(self._maps[self._files[index]])[offset:offset + self._lengths[index]]
+
+    def snapshot(self, index):
+        """Return the decoded snapshot of a record."""
+        return json.loads(bytes(self.payload(index)))
+
+    def index_at(self, timestamp):
+        """Return the index of the last record at or before timestamp, -1 if none."""
+        return bisect_right(self._timestamps, timestamp) - 1
+
+    def at(self, timestamp):
+        """Return the snapshot current at timestamp, or None."""
+        index = self.index_at(timestamp)
+        return None if index < 0 else self.snapshot(index)
+
+    def between(self, start, end):
+        """Yield (timestamp, snapshot) of the records from start to end (inclusive)."""
+        for index in range(max(0, self.index_at(start - 1e-6) + 1), self.index_at(end) + 1):
+            yield self._timestamps[index], self.snapshot(index)
+
+"""=================================================================================================================="""
+
+class TeslaFiReplay:
+    """Source answering the controller requests from a snapshot log, in place of HTTP"""
+
+    def __init__(self, reader, speed=DEFAULT_REPLAY_SPEED, start=None):
+        """Initialise the replay of reader, speed times faster than recorded, from start (epoch)."""
+        self._reader = reader
+        self._speed = speed
+        self._start = start
+        self._index = 0
+        self._last_good = None
+        # Same interface as TeslaFiTransport, never opened
+        self.breaker = CircuitBreaker()
+        self.metrics = None
+
+    def open(self):
+        """Open the log and move to the start. Blocking."""
+        self._reader.open()
+        if self._start is not None:
+            self._index = max(0, self._reader.index_at(self._start))
+        # The last good data may be recorded before the start
+        for index in range(self._index, -1, -1):
+            if self._is_online(index):
+                self._last_good = index
+                break
+
+    def close(self):
+        """Close the log. Blocking."""
+        self._reader.close()
+
+    def _is_online(self, index):
+        return self._reader.snapshot(index).get('id') is not None
+
+    def time(self):
+        """Return the recording time of the current snapshot."""
+        if not len(self._reader):
+            return 0
+        return self._reader.timestamp(self._index)
+
+    def invalidate(self, url=None):
+        """Nothing cached."""
+
+    async def async_get(self, url, retry=True, conditional=False):
+        """Answer a request of the controller like TeslaFi did at the current time."""
+        if not len(self._reader):
+            return None
+        if 'command=lastGood' in url:
+            return None if self._last_good is None else self._reader.snapshot(self._last_good)
+        if 'command=' in url:
+            return {'response': {'result': False, 'reason': 'replay'}}
+        return self._reader.snapshot(self._index)
+
+    async def async_run(self, controller):
+        """Refresh the controller with each snapshot, at the replay speed."""
+        _LOGGER.info("Replaying %s TeslaFi snapshots at %sx", len(self._reader) - self._index, self._speed)
+        while self._index + 1 < len(self._reader):
+            gap = self._reader.timestamp(self._index + 1) - self._reader.timestamp(self._index)
+            await asyncio.sleep(max(0, gap) / self._speed)
+            self._index += 1
+            if self._is_online(self._index):
+                self._last_good = self._index
+            await controller.async_refresh()
+        _LOGGER.info("TeslaFi replay finished")
@@ -4,6 +4,7 @@ from homeassistant.helpers.entity import Entity
 from homeassistant.components.switch import SwitchDevice
 
 from . import DOMAIN, TeslaFi, TeslaFiDevice
+from .snapshot import convert
 
 """=================================================================================================================="""
 
@@ -18,11 +19,10 @@ async def async_setup_platform(hass, config, add_entities, discovery_info=None):
     if discovery_info is None:
         return
 
-    controller = hass.data[DOMAIN]["controller"]
-
     devices = []
-    devices.append(TeslaFiSwitch(controller, '_wake', 'switch', 'state', 'online', 'wake_up', None))
-    #devices.append(TeslaFiSwitch(controller, '_charge', 'switch', 'charge_enable_request', 'True', 'charge_start', 'charge_stop'))
+    for controller in hass.data[DOMAIN]["controllers"]:
+        devices.append(TeslaFiSwitch(controller, '_wake', 'switch', 'state', 'online', 'wake_up', None))
+        #devices.append(TeslaFiSwitch(controller, '_charge', 'switch', 'charge_enable_request', True, 'charge_start', 'charge_stop'))
 
     add_entities(devices, True)
 
@@ -54,31 +54,43 @@ class TeslaFiSwitch(SwitchDevice, TeslaFiDevice):
             return "mdi:toggle-switch-off"
 
 
-    def turn_on(self, **kwargs):
+    def _off_value(self):
+        """Return a value different from the on value."""
+        if isinstance(self._on_value, bool):
+            return not self._on_value
+        return '!' + self._on_value
+
+
+    async def async_turn_on(self, **kwargs):
         """Send the turn on command."""
         _LOGGER.debug("Turn on switch for: %s", self.name)
-        res = self._controller.send(self._on_command)
+        res = await self._controller.async_send(self._on_command)
+        if res is None:
+            # Superseded or failed, the refresh after the commands tells the state
+            return
         # Overrides buffer with response (valid until next polling)
-        if res['response'][self._api_key] == self._on_value:
-            self._current_value[self._api_key] = self._on_value
+        if convert(self._api_key, res['response'].get(self._api_key)) == self._on_value:
+            self._controller.async_set_optimistic(self._api_key, self._on_value)
         else:
-            self._current_value[self._api_key] = '!' + self._on_value
+            self._controller.async_set_optimistic(self._api_key, self._off_value())
 
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         _LOGGER.debug("Turn off switch for: %s", self.name)
         if self._off_command is not None:
-            res = self._controller.send(self._off_command)
+            res = await self._controller.async_send(self._off_command)
+            if res is None:
+                return
             # Overrides buffer with response (valid until next polling)
-            if res['response'][self._api_key] == self._on_value:
-                self._current_value[self._api_key] = self._on_value
+            if convert(self._api_key, res['response'].get(self._api_key)) == self._on_value:
+                self._controller.async_set_optimistic(self._api_key, self._on_value)
             else:
-                self._current_value[self._api_key] = '!' + self._on_value
+                self._controller.async_set_optimistic(self._api_key, self._off_value())
 
 
     @property
     def is_on(self):
         """Get whether the lock is in locked state."""
-        return self._current_value[self._api_key] == self._on_value
+        return self._value() == self._on_value
 
 """=================================================================================================================="""
@@ -0,0 +1,227 @@
+"""In-memory time series of the TeslaFi numeric fields."""
+from array import array
+import logging
+import math
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FIELDS = [
+    'battery_level',
+    'usable_battery_level',
+    'charger_actual_current',
+    'charger_power',
+    'charge_energy_added',
+    'est_battery_range',
+    'odometer',
+    'inside_temp',
+    'outside_temp',
+]
+
+# Longest window queried, covered by the coarsest resolution
+MAX_WINDOW = 7 * 24 * 3600
+# Number of points kept per resolution: 6h of 1 minute polls, a day of 5 minutes, MAX_WINDOW of hours
+RAW_CAPACITY = 360
+FIVE_MINUTES = 300
+FIVE_MINUTES_CAPACITY = 288
+HOUR = 3600
+HOUR_CAPACITY = MAX_WINDOW // HOUR
+
+# Column types: int32 seconds since the series origin, float32 values, uint16 counts
+RAW_COLUMNS = 'if'
+TIER_COLUMNS = 'ifffHff'
+
+RESOLUTION_RAW = "raw"
+RESOLUTION_5MIN = "5min"
+RESOLUTION_HOUR = "hour"
+
+"""=================================================================================================================="""
+
+class _Ring:
+    """Fixed-size ring of rows stored column-wise in preallocated typed arrays"""
+
+    __slots__ = ('capacity', 'columns', 'head', 'size')
+
+    def __init__(self, capacity, typecodes):
+        self.capacity = capacity
+        self.columns = tuple(array(typecode, [0]) * capacity for typecode in typecodes)
+        self.head = 0
+        self.size = 0
+
+    def append(self, *row):
+        for column, value in zip(self.columns, row):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def oldest(self):
+        """Return the first column (time) of the oldest row, or None."""
+        if not self.size:
+            return None
+        return self.columns[0][(self.head - self.size) % self.capacity]
+
+    def since(self, start):
+        """Yield, oldest first, the indexes of the rows with a time >= start."""
+        times = self.columns[0]
+        for offset in range(self.size, 0, -1):
+            index = (self.head - offset) % self.capacity
+            if times[index] >= start:
+                yield index
+
+"""=================================================================================================================="""
+
+class _Tier:
+    """Downsampled resolution: one (start, min, max, sum, count, first, last) row per bucket"""
+
+    __slots__ = ('period', 'ring', '_bucket')
+
+    def __init__(self, period, capacity):
+        self.period = period
+        self.ring = _Ring(capacity, TIER_COLUMNS)
+        self._bucket = None
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.period
+        bucket = self._bucket
+        if bucket is not None and bucket[0] != start:
+            self.ring.append(*bucket)
+            bucket = None
+        if bucket is None:
+            self._bucket = [start, value, value, value, 1, value, value]
+            return
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        bucket[3] += value
+        bucket[4] += 1
+        bucket[6] = value
+
+    def rows(self, start):
+        """Yield the (start, min, max, sum, count, first, last) rows of the buckets started since start.
+
+        A bucket started before start is left out, most of its samples are: the
+        rows cover start rounded up to the period, the current bucket included.
+        """
+        columns = self.ring.columns
+        for index in self.ring.since(start):
+            yield tuple(column[index] for column in columns)
+        if self._bucket is not None and self._bucket[0] >= start:
+            yield tuple(self._bucket)
+
+    def oldest(self):
+        oldest = self.ring.oldest()
+        if oldest is None and self._bucket is not None:
+            return self._bucket[0]
+        return oldest
+
+"""=================================================================================================================="""
+
+class TeslaFiSeries:
+    """Ring buffers of one numeric field at raw, 5 minutes and hourly resolutions
+
+    Times are stored in seconds since an origin aligned on the hour, so the
+    buckets of the tiers stay aligned on the clock.
+    """
+
+    __slots__ = ('_origin', '_raw', '_tiers')
+
+    def __init__(self):
+        self._origin = None
+        self._raw = _Ring(RAW_CAPACITY, RAW_COLUMNS)
+        self._tiers = (
+            (RESOLUTION_5MIN, _Tier(FIVE_MINUTES, FIVE_MINUTES_CAPACITY)),
+            (RESOLUTION_HOUR, _Tier(HOUR, HOUR_CAPACITY)),
+        )
+
+    def add(self, timestamp, value):
+        """Add a sample, timestamp in seconds."""
+        if self._origin is None:
+            self._origin = int(timestamp) - int(timestamp) % HOUR
+        offset = int(timestamp) - self._origin
+        self._raw.append(offset, value)
+        for _, tier in self._tiers:
+            tier.add(offset, value)
+
+    def query(self, window, now):
+        """Return min/max/mean/rate (per hour) over the last window seconds, or None without data.
+
+        Uses the finest resolution still covering the whole window, at most MAX_WINDOW.
+        """
+        if self._origin is None:
+            return None
+        start = now - min(window, MAX_WINDOW) - self._origin
+        oldest = self._raw.oldest()
+        if oldest is not None and (oldest <= start or self._raw.size < self._raw.capacity):
+            return self._query_raw(start)
+        for resolution, tier in self._tiers:
+            oldest = tier.oldest()
+            if oldest is not None and oldest <= start:
+                return self._query_tier(resolution, tier, start)
+        # Not enough history: use the coarsest resolution, which covers the most
+        resolution, tier = self._tiers[-1]
+        return self._query_tier(resolution, tier, start)
+
+    def _query_raw(self, start):
+        times, values = self._raw.columns
+        indexes = list(self._raw.since(start))
+        if not indexes:
+            return None
+        selected = [values[index] for index in indexes]
+        first, last = indexes[0], indexes[-1]
+        return _result(
+            RESOLUTION_RAW, min(selected), max(selected), math.fsum(selected), len(selected),
+            times[first], values[first], times[last], values[last],
+        )
+
+    @staticmethod
+    def _query_tier(resolution, tier, start):
+        rows = list(tier.rows(start))
+        if not rows:
+            return None
+        return _result(
+            resolution,
+            min(row[1] for row in rows),
+            max(row[2] for row in rows),
+            math.fsum(row[3] for row in rows),
+            int(sum(row[4] for row in rows)),
+            rows[0][0], rows[0][5], rows[-1][0], rows[-1][6],
+        )
+
+
+def _result(resolution, minimum, maximum, total, count, first_time, first, last_time, last):
+    elapsed = last_time - first_time
+    return {
+        'resolution': resolution,
+        'count': count,
+        'min': minimum,
+        'max': maximum,
+        'mean': total / count,
+        'rate': (last - first) * HOUR / elapsed if elapsed > 0 else 0.0,
+    }
+
+"""=================================================================================================================="""
+
+class TeslaFiHistory:
+    """Bounded in-memory history of the numeric fields of a vehicle"""
+
+    def __init__(self, fields=None):
+        """Initialise the history for the given fields."""
+        self.fields = tuple(DEFAULT_HISTORY_FIELDS if fields is None else fields)
+        self._series = {field: TeslaFiSeries() for field in self.fields}
+
+    def record(self, snapshot, timestamp):
+        """Record the numeric values of a snapshot."""
+        if snapshot is None:
+            return
+        for field, series in self._series.items():
+            value = snapshot[field]
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                series.add(timestamp, float(value))
+
+    def query(self, field, window, now):
+        """Return the windowed min/max/mean/rate of a field, window and now in seconds."""
+        series = self._series.get(field)
+        if series is None:
+            return None
+        return series.query(window, now)
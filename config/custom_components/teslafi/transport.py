@@ -0,0 +1,227 @@
+"""Resilient HTTP transport for the TeslaFi API."""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+
+import aiohttp
+from aiohttp import hdrs
+import async_timeout
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 2
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 60
+RESET_TIMEOUT_MAX = 1800
+
+# Returned by conditional requests when the response did not change
+NOT_MODIFIED = object()
+
+"""=================================================================================================================="""
+
+class TeslaFiError(Exception):
+    """Error communicating with TeslaFi."""
+
+    transient = True
+
+
+class TeslaFiTransientError(TeslaFiError):
+    """Error worth retrying: timeout, connection error, 5xx, 429 or garbled response."""
+
+
+class TeslaFiPermanentError(TeslaFiError):
+    """Error not worth retrying: bad token, unknown request."""
+
+    transient = False
+
+
+class TeslaFiCircuitOpenError(TeslaFiError):
+    """Request not sent: too many recent failures."""
+
+    transient = False
+
+
+def classify(exception):
+    """Wrap a low level exception into a TeslaFiError."""
+    if isinstance(exception, TeslaFiError):
+        return exception
+    if isinstance(exception, aiohttp.ClientResponseError):
+        if exception.status == 429 or exception.status >= 500:
+            return TeslaFiTransientError(f"HTTP {exception.status}")
+        return TeslaFiPermanentError(f"HTTP {exception.status}")
+    if isinstance(exception, asyncio.TimeoutError):
+        return TeslaFiTransientError("Timeout")
+    if isinstance(exception, aiohttp.ClientError):
+        return TeslaFiTransientError(repr(exception))
+    if isinstance(exception, ValueError):
+        return TeslaFiTransientError(f"Invalid response: {exception}")
+    return TeslaFiPermanentError(repr(exception))
+
+
+def backoff(attempt):
+    """Return an exponential backoff delay with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+"""=================================================================================================================="""
+
+class CircuitBreaker:
+    """Stop sending requests after repeated failures, probing again after a growing delay"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        """Initialise the breaker."""
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._state = self.CLOSED
+
+    @property
+    def state(self):
+        """Return the state of the breaker."""
+        if self._state == self.OPEN and self.retry_in() == 0:
+            return self.HALF_OPEN
+        return self._state
+
+    def retry_in(self):
+        """Return the seconds left before a request is allowed again."""
+        if self._state != self.OPEN:
+            return 0
+        return max(0, self._opened_at + self._timeout - time.monotonic())
+
+    def allow(self):
+        """Return True if a request may be sent (a single probe when half open)."""
+        if self._state == self.CLOSED:
+            return True
+        if self._state == self.OPEN and self.retry_in() == 0:
+            self._state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        """Close the breaker."""
+        if self._state != self.CLOSED:
+            _LOGGER.info("TeslaFi API reachable again")
+        self._state = self.CLOSED
+        self._failures = 0
+        self._timeout = self._reset_timeout
+
+    def record_cancelled(self):
+        """Count a cancelled probe as failed, as the breaker would stay half open without an outcome."""
+        if self._state == self.HALF_OPEN:
+            self.record_failure()
+
+    def record_failure(self):
+        """Count a failure, opening the breaker over the threshold."""
+        self._failures += 1
+        if self._state == self.HALF_OPEN:
+            # The probe failed: wait longer before the next one
+            self._timeout = min(self._timeout * 2, RESET_TIMEOUT_MAX)
+        elif self._failures < self._threshold:
+            return
+        if self._state != self.OPEN:
+            _LOGGER.warning("TeslaFi API unreachable, pausing requests for %ss", self._timeout)
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+
+"""=================================================================================================================="""
+
+class TeslaFiTransport:
+    """HTTP requests to TeslaFi with retries, backoff and a circuit breaker"""
+
+    def __init__(self, session, timeout, retries=DEFAULT_RETRIES, metrics=None):
+        """Initialise the transport on a shared aiohttp session, recording sizes in metrics if given."""
+        self._session = session
+        self.metrics = metrics
+        self._timeout = timeout
+        self._retries = retries
+        self.breaker = CircuitBreaker()
+        # url -> (etag, last modified, body digest) of the last response
+        self._validators = {}
+
+    def invalidate(self, url=None):
+        """Forget the previous responses (of url only if given), the next requests return full data."""
+        if url is None:
+            self._validators.clear()
+        else:
+            self._validators.pop(url, None)
+
+    async def _async_fetch(self, url, conditional):
+        # Compressed bodies are decompressed by aiohttp as they stream in
+        headers = {hdrs.ACCEPT_ENCODING: 'gzip, deflate'}
+        previous = self._validators.get(url) if conditional else None
+        if previous is not None:
+            etag, last_modified, _ = previous
+            if etag:
+                headers[hdrs.IF_NONE_MATCH] = etag
+            if last_modified:
+                headers[hdrs.IF_MODIFIED_SINCE] = last_modified
+
+        with async_timeout.timeout(self._timeout):
+            resp = await self._session.get(url, headers=headers)
+            if resp.status == 304 and previous is not None:
+                resp.release()
+                return NOT_MODIFIED
+            resp.raise_for_status()
+            body = await resp.read()
+
+        digest = None
+        if conditional:
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            # Same body as the last parsed one: skip the JSON parsing
+            if previous is not None and previous[2] == digest:
+                if self.metrics is not None:
+                    self.metrics.record_response(len(body))
+                return NOT_MODIFIED
+        started = time.perf_counter()
+        data = json.loads(body.decode(resp.charset or 'utf-8'))
+        if self.metrics is not None:
+            self.metrics.record_response(len(body), time.perf_counter() - started)
+        # Only a body that parsed can be answered by NOT_MODIFIED next time
+        if digest is not None and isinstance(data, dict):
+            self._validators[url] = (
+                resp.headers.get(hdrs.ETAG), resp.headers.get(hdrs.LAST_MODIFIED), digest
+            )
+        return data
+
+    async def async_get(self, url, retry=True, conditional=False):
+        """Return the decoded JSON response of a request.
+
+        Transient errors are retried when retry is True. When conditional is True,
+        NOT_MODIFIED is returned if the response did not change since the previous
+        conditional request of the same url. Raises TeslaFiError.
+        """
+        attempts = self._retries + 1 if retry else 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise TeslaFiCircuitOpenError(
+                    f"Requests paused for {round(self.breaker.retry_in())}s"
+                )
+            try:
+                data = await self._async_fetch(url, conditional)
+            except asyncio.CancelledError:
+                self.breaker.record_cancelled()
+                raise
+            except Exception as exception_:  # pylint: disable=broad-except
+                error = classify(exception_)
+                self.breaker.record_failure()
+                if not error.transient or attempt + 1 >= attempts:
+                    raise error from exception_
+                delay = backoff(attempt)
+                _LOGGER.debug("TeslaFi request failed (%s), retrying in %.1fs", error, delay)
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return data
@@ -0,0 +1,237 @@
+"""Incremental trip segmentation for TeslaFi vehicles."""
+import json
+import logging
+import os
+
+from .geo import TrajectoryCompressor, distance
+from .scheduler import STATE_DRIVING, vehicle_state
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+# Keys the trip builder needs in the snapshot
+TRIP_KEYS = (
+    'carState',
+    'shift_state',
+    'speed',
+    'odometer',
+    'latitude',
+    'longitude',
+    'battery_level',
+    'battery_range',
+)
+
+METERS_PER_MILE = 1609.344
+# Trips shorter than this (miles) are GPS noise or parking maneuvers
+MIN_TRIP_DISTANCE = 0.1
+
+"""=================================================================================================================="""
+
+class TeslaFiTrip:
+    """Running statistics of one drive, updated in O(1) per snapshot"""
+
+    __slots__ = (
+        'start', 'end', 'start_odometer', 'end_odometer', 'gps_distance', 'max_speed',
+        'start_battery_level', 'end_battery_level', 'start_range', 'end_range',
+        'start_position', 'end_position', 'polyline', '_trace',
+    )
+
+    def __init__(self, start, tolerance):
+        """Start a trip at a timestamp."""
+        self.start = start
+        self.end = start
+        self.start_odometer = None
+        self.end_odometer = None
+        self.gps_distance = 0.0
+        self.max_speed = 0.0
+        self.start_battery_level = None
+        self.end_battery_level = None
+        self.start_range = None
+        self.end_range = None
+        self.start_position = None
+        self.end_position = None
+        self.polyline = None
+        self._trace = TrajectoryCompressor(tolerance)
+
+    @property
+    def duration(self):
+        """Return the duration in seconds."""
+        return self.end - self.start
+
+    @property
+    def distance(self):
+        """Return the distance in miles, from the odometer when available."""
+        if self.start_odometer is not None and self.end_odometer is not None:
+            return self.end_odometer - self.start_odometer
+        return self.gps_distance / METERS_PER_MILE
+
+    @property
+    def average_speed(self):
+        """Return the average speed in mph."""
+        return self.distance * 3600 / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def battery_used(self):
+        """Return the battery level used, in percentage points."""
+        if self.start_battery_level is None or self.end_battery_level is None:
+            return None
+        return self.start_battery_level - self.end_battery_level
+
+    def add(self, snapshot, timestamp):
+        """Aggregate one snapshot."""
+        self.end = timestamp
+
+        odometer = snapshot['odometer']
+        if odometer is not None:
+            if self.start_odometer is None:
+                self.start_odometer = odometer
+            self.end_odometer = odometer
+
+        speed = snapshot['speed']
+        if speed is not None:
+            self.max_speed = max(self.max_speed, speed)
+
+        level = snapshot['battery_level']
+        if level is not None:
+            if self.start_battery_level is None:
+                self.start_battery_level = level
+            self.end_battery_level = level
+
+        rated = snapshot['battery_range']
+        if rated is not None:
+            if self.start_range is None:
+                self.start_range = rated
+            self.end_range = rated
+
+        lat = snapshot['latitude']
+        lon = snapshot['longitude']
+        if lat is not None and lon is not None:
+            if self.end_position is not None:
+                self.gps_distance += distance(self.end_position[0], self.end_position[1], lat, lon)
+            else:
+                self.start_position = (lat, lon)
+            self.end_position = (lat, lon)
+            self._trace.add(lat, lon)
+
+    def finish(self):
+        """Close the trip, compressing its trace."""
+        self.polyline = self._trace.finish()
+        self._trace = None
+
+    def as_dict(self, battery_capacity=None):
+        """Return the trip as a dict; energy is estimated from the battery capacity (kWh)."""
+        battery_used = self.battery_used
+        energy = None
+        if battery_capacity and battery_used is not None:
+            energy = round(battery_used * battery_capacity / 100, 2)
+        return {
+            'start': self.start,
+            'end': self.end,
+            'duration': round(self.duration),
+            'distance': round(self.distance, 2),
+            'average_speed': round(self.average_speed, 1),
+            'max_speed': self.max_speed,
+            'battery_used': battery_used,
+            'range_used': (None if self.start_range is None
+                           else round(self.start_range - self.end_range, 1)),
+            'energy_used': energy,
+            'start_position': self.start_position,
+            'end_position': self.end_position,
+            'polyline': self.polyline,
+        }
+
+"""=================================================================================================================="""
+
+class TeslaFiTripBuilder:
+    """Segment drives from the snapshot stream"""
+
+    def __init__(self, tolerance):
+        """Initialise the builder, trace tolerance in meters."""
+        self._tolerance = tolerance
+        self.current = None
+        self.last = None
+
+    def update(self, snapshot, timestamp):
+        """Feed a snapshot. Returns the trip finished by it, or None."""
+        if snapshot is None:
+            return None
+
+        if vehicle_state(snapshot, True) == STATE_DRIVING:
+            if self.current is None:
+                _LOGGER.debug("Trip started")
+                self.current = TeslaFiTrip(timestamp, self._tolerance)
+            self.current.add(snapshot, timestamp)
+            return None
+
+        if self.current is None:
+            return None
+
+        trip = self.current
+        self.current = None
+        trip.add(snapshot, timestamp)
+        trip.finish()
+        if trip.distance < MIN_TRIP_DISTANCE:
+            _LOGGER.debug("Ignoring trip of %.2f miles", trip.distance)
+            return None
+        self.last = trip
+        return trip
+
+"""=================================================================================================================="""
+
+class TeslaFiTripStore:
+    """Append-only store of finished trips, one compact JSON line each, indexed by date
+
+    Blocking methods, run them in the executor.
+    """
+
+    def __init__(self, path):
+        """Initialise the store at path."""
+        self._path = path
+        # date (YYYY-MM-DD) -> byte offsets of the trips of that day
+        self._index = {}
+        self._offsets = []
+
+    def load(self):
+        """Build the date index from the file."""
+        self._index = {}
+        self._offsets = []
+        try:
+            with open(self._path, 'rb') as store:
+                offset = 0
+                for line in store:
+                    if line.endswith(b'\n'):
+                        self._add_to_index(json.loads(line)['date'], offset)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+    def _add_to_index(self, date, offset):
+        self._index.setdefault(date, []).append(offset)
+        self._offsets.append(offset)
+
+    def append(self, date, trip):
+        """Append a finished trip (dict) of a day."""
+        line = json.dumps(dict(trip, date=date), separators=(',', ':')).encode() + b'\n'
+        with open(self._path, 'ab') as store:
+            offset = store.seek(0, os.SEEK_END)
+            store.write(line)
+        self._add_to_index(date, offset)
+
+    def _read(self, offsets):
+        if not offsets:
+            return []
+        trips = []
+        with open(self._path, 'rb') as store:
+            for offset in offsets:
+                store.seek(offset)
+                trips.append(json.loads(store.readline()))
+        return trips
+
+    def last(self, count):
+        """Return the last count trips, oldest first."""
+        return self._read(self._offsets[-count:] if count > 0 else [])
+
+    def on_date(self, date):
+        """Return the trips of a day (YYYY-MM-DD)."""
+        return self._read(self._index.get(date, []))
@@ -0,0 +1,165 @@
+"""Spatial index of the Home Assistant zones for the TeslaFi tracker."""
+from collections import OrderedDict
+import logging
+import math
+
+from homeassistant.const import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    EVENT_STATE_CHANGED,
+    STATE_HOME,
+    STATE_NOT_HOME,
+)
+from homeassistant.core import callback
+
+from .geo import EARTH_RADIUS, distance
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+ZONE_DOMAIN = "zone"
+ZONE_HOME = "zone.home"
+ATTR_RADIUS = "radius"
+ATTR_PASSIVE = "passive"
+
+# Grid cells of 0.01 degree (about 1 km)
+CELL_SIZE = 0.01
+# Lookups are cached per cell of 1e-4 degree (about 11 m)
+QUANTIZATION = 1e4
+CACHE_SIZE = 1024
+
+"""=================================================================================================================="""
+
+def _quantize(lat, lon):
+    return (int(round(lat * QUANTIZATION)), int(round(lon * QUANTIZATION)))
+
+
+def _cell(lat, lon):
+    return (int(math.floor(lat / CELL_SIZE)), int(math.floor(lon / CELL_SIZE)))
+
+
+class LRUCache:
+    """Bounded least recently used cache"""
+
+    __slots__ = ('_size', '_data')
+
+    def __init__(self, size=CACHE_SIZE):
+        self._size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return a cached value, marking it as recently used."""
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def set(self, key, value):
+        """Cache a value, evicting the least recently used one if full."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self._size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """Empty the cache."""
+        self._data.clear()
+
+"""=================================================================================================================="""
+
+class TeslaFiZoneIndex:
+    """Grid index of the zones, resolving positions like the device tracker does"""
+
+    def __init__(self, hass):
+        """Initialise the index, built lazily from the zone states."""
+        self._hass = hass
+        self._grid = {}
+        self._dirty = True
+        self._zones = LRUCache()
+        self._places = LRUCache()
+        self._unsub = None
+
+    @callback
+    def async_start(self):
+        """Rebuild the index when a zone changes."""
+
+        @callback
+        def zone_changed(event):
+            if event.data.get('entity_id', '').startswith(ZONE_DOMAIN + '.'):
+                self._dirty = True
+
+        self._unsub = self._hass.bus.async_listen(EVENT_STATE_CHANGED, zone_changed)
+
+    @callback
+    def async_stop(self, event=None):
+        """Stop following the zones."""
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+    def _build(self):
+        """Add every active zone to the grid cells its circle covers."""
+        self._grid = {}
+        count = 0
+        for state in self._hass.states.async_all():
+            if state.domain != ZONE_DOMAIN or state.attributes.get(ATTR_PASSIVE):
+                continue
+            lat = state.attributes.get(ATTR_LATITUDE)
+            lon = state.attributes.get(ATTR_LONGITUDE)
+            radius = state.attributes.get(ATTR_RADIUS, 0)
+            if lat is None or lon is None:
+                continue
+            zone = (state.entity_id, state.name, lat, lon, radius)
+            dlat = math.degrees(radius / EARTH_RADIUS)
+            dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+            lat_min, lon_min = _cell(lat - dlat, lon - dlon)
+            lat_max, lon_max = _cell(lat + dlat, lon + dlon)
+            for i in range(lat_min, lat_max + 1):
+                for j in range(lon_min, lon_max + 1):
+                    self._grid.setdefault((i, j), []).append(zone)
+            count += 1
+        self._zones.clear()
+        self._dirty = False
+        _LOGGER.debug("Indexed %s zones in %s cells", count, len(self._grid))
+
+    def zone(self, lat, lon):
+        """Return the state of the device tracker at a position: home, a zone name or not_home."""
+        if self._dirty:
+            self._build()
+
+        key = _quantize(lat, lon)
+        state = self._zones.get(key)
+        if state is not None:
+            return state
+
+        closest = None
+        for entity_id, name, zone_lat, zone_lon, radius in self._grid.get(_cell(lat, lon), ()):
+            dist = distance(lat, lon, zone_lat, zone_lon)
+            if dist > radius:
+                continue
+            # Same choice as Home Assistant: closest zone, then smallest one
+            if closest is None or (dist, radius) < closest[:2]:
+                closest = (dist, radius, entity_id, name)
+
+        if closest is None:
+            state = STATE_NOT_HOME
+        elif closest[2] == ZONE_HOME:
+            state = STATE_HOME
+        else:
+            state = closest[3]
+        self._zones.set(key, state)
+        return state
+
+    def learn_place(self, lat, lon, place):
+        """Remember the place name reported by TeslaFi at a position."""
+        if place:
+            self._places.set(_quantize(lat, lon), place)
+
+    def place(self, lat, lon):
+        """Return a place name known at a position, or None."""
+        return self._places.get(_quantize(lat, lon))
@@ -0,0 +1,280 @@
+"""Load test and latency benchmark of the TeslaFi integration against a local fake feed.
+
+Run from the repository root, with Home Assistant installed:
+
+    PYTHONPATH=config python scripts/teslafi_benchmark.py --vehicles 1 10 50 --polls 30
+
+Each run sets up a Home Assistant instance with the integration and all its platforms
+for N simulated vehicles, then drives the polls itself, one round being one poll of
+every vehicle (one scan interval).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from homeassistant import core
+from homeassistant.const import (
+    ATTR_ENTITY_ID,
+    EVENT_HOMEASSISTANT_CLOSE,
+    EVENT_HOMEASSISTANT_STOP,
+)
+from homeassistant.helpers import discovery
+from homeassistant.setup import async_setup_component
+
+from custom_components.teslafi import DOMAIN
+from teslafi_fake_feed import ENDPOINTS, FakeFeedServer
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+# Platforms not loaded by default, set up explicitly to benchmark them too
+EXTRA_PLATFORMS = ("lock", "switch")
+
+MONITOR_INTERVAL = 0.005
+
+"""=================================================================================================================="""
+
+def percentile(values, share):
+    """Return the value below which a share (0..1) of the values fall."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+class LoopMonitor:
+    """Measure how long the event loop is blocked, from the lateness of a periodic wakeup"""
+
+    def __init__(self, interval=MONITOR_INTERVAL):
+        """Initialise the monitor."""
+        self._interval = interval
+        self._task = None
+        self.reset()
+
+    def reset(self):
+        """Reset the measures."""
+        self.blocked = 0.0
+        self.max_blocked = 0.0
+
+    async def _async_run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            late = loop.time() - expected
+            if late > 0:
+                self.blocked += late
+                self.max_blocked = max(self.max_blocked, late)
+
+    def start(self):
+        """Start monitoring."""
+        self._task = asyncio.ensure_future(self._async_run())
+
+    async def async_stop(self):
+        """Stop monitoring."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+"""=================================================================================================================="""
+
+class StateWriteCounter:
+    """Count the state writes of the entities"""
+
+    def __init__(self, hass):
+        """Wrap the state machine of hass."""
+        self.count = 0
+        async_set = hass.states.async_set
+
+        def counting_async_set(*args, **kwargs):
+            self.count += 1
+            return async_set(*args, **kwargs)
+
+        hass.states.async_set = counting_async_set
+
+
+async def _async_timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+async def _async_send_commands(hass):
+    """Lock the doors and wake the vehicles, through the entities."""
+    for domain, service in (("lock", "lock"), ("switch", "turn_on")):
+        entity_ids = hass.states.async_entity_ids(domain)
+        if entity_ids:
+            await hass.services.async_call(domain, service, {ATTR_ENTITY_ID: entity_ids}, blocking=False)
+
+"""=================================================================================================================="""
+
+async def async_run(vehicles, args):
+    """Benchmark the integration for a number of vehicles. Returns the results as a dict."""
+    server = FakeFeedServer(
+        vehicles, args.latency, args.jitter, args.payload_size, args.error_rate, args.transition_every
+    )
+    await server.async_start()
+
+    config_dir = tempfile.TemporaryDirectory()
+    hass = core.HomeAssistant()
+    hass.config.config_dir = config_dir.name
+    hass.config.skip_pip = True
+    hass.config.latitude = 45.5
+    hass.config.longitude = -73.6
+
+    config = {
+        DOMAIN: {
+            "accounts": [{"access_token": token} for token in server.vehicles],
+            "url": server.url,
+        }
+    }
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    setup_start = time.perf_counter()
+    if not await async_setup_component(hass, DOMAIN, config):
+        raise RuntimeError("TeslaFi setup failed")
+    for platform in EXTRA_PLATFORMS:
+        hass.async_create_task(discovery.async_load_platform(hass, platform, DOMAIN, {}, config))
+    await hass.async_block_till_done()
+    setup_time = time.perf_counter() - setup_start
+
+    # The benchmark drives the polls, not the timers
+    pool = hass.data[DOMAIN]["pool"]
+    pool.async_stop()
+    writes = StateWriteCounter(hass)
+    monitor = LoopMonitor()
+    monitor.start()
+
+    rounds = []
+    for index in range(args.warmup + args.polls):
+        if index == args.warmup:
+            # Memory is measured once warm, then tracing is stopped not to skew the timings
+            memory = tracemalloc.get_traced_memory()[0] - baseline
+            tracemalloc.stop()
+        server.reset_counters()
+        writes.count = 0
+        monitor.reset()
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(
+            *(_async_timed(controller.async_refresh()) for controller in pool.controllers)
+        )
+        if args.command_every and index % args.command_every == 0:
+            await _async_send_commands(hass)
+        await hass.async_block_till_done()
+        duration = time.perf_counter() - start
+
+        if index >= args.warmup:
+            rounds.append({
+                "latencies": latencies,
+                "duration": duration,
+                "blocked": monitor.blocked,
+                "max_blocked": monitor.max_blocked,
+                "requests": dict(server.requests),
+                "errors": server.errors,
+                "not_modified": server.not_modified,
+                "bytes": server.bytes_sent,
+                "writes": writes.count,
+            })
+
+    await monitor.async_stop()
+    entities = len(hass.states.async_all())
+    # Stopped by hand: hass.async_stop() expects a running instance
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STOP)
+    await hass.async_block_till_done()
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_CLOSE)
+    await hass.async_block_till_done()
+    hass.executor.shutdown()
+    await server.async_stop()
+    config_dir.cleanup()
+
+    latencies = [latency for round_ in rounds for latency in round_["latencies"]]
+    polls = len(latencies)
+    return {
+        "vehicles": vehicles,
+        "entities": entities,
+        "setup_s": setup_time,
+        "poll_latency_ms": {
+            "p50": percentile(latencies, 0.5) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "round_ms": statistics.mean(round_["duration"] for round_ in rounds) * 1000,
+        "loop_blocked_ms_per_round": statistics.mean(round_["blocked"] for round_ in rounds) * 1000,
+        "loop_max_blocked_ms": max(round_["max_blocked"] for round_ in rounds) * 1000,
+        "requests_per_interval": {
+            endpoint: statistics.mean(round_["requests"][endpoint] for round_ in rounds)
+            for endpoint in ENDPOINTS
+        },
+        "errors_per_interval": statistics.mean(round_["errors"] for round_ in rounds),
+        "not_modified_per_interval": statistics.mean(round_["not_modified"] for round_ in rounds),
+        "bytes_per_interval": statistics.mean(round_["bytes"] for round_ in rounds),
+        "state_writes_per_poll": sum(round_["writes"] for round_ in rounds) / polls,
+        "memory_per_vehicle_kib": memory / vehicles / 1024,
+    }
+
+"""=================================================================================================================="""
+
+def _print_results(results):
+    columns = (
+        ("vehicles", lambda r: r["vehicles"]),
+        ("entities", lambda r: r["entities"]),
+        ("p50 ms", lambda r: r["poll_latency_ms"]["p50"]),
+        ("p95 ms", lambda r: r["poll_latency_ms"]["p95"]),
+        ("max ms", lambda r: r["poll_latency_ms"]["max"]),
+        ("blocked ms", lambda r: r["loop_blocked_ms_per_round"]),
+        ("max block ms", lambda r: r["loop_max_blocked_ms"]),
+        ("req/interval", lambda r: sum(r["requests_per_interval"].values())),
+        ("304/interval", lambda r: r["not_modified_per_interval"]),
+        ("writes/poll", lambda r: r["state_writes_per_poll"]),
+        ("KiB/vehicle", lambda r: r["memory_per_vehicle_kib"]),
+    )
+    print("  ".join(f"{name:>12}" for name, _ in columns))
+    for result in results:
+        cells = []
+        for _, value in columns:
+            value = value(result)
+            cells.append(f"{value:>12.1f}" if isinstance(value, float) else f"{value:>12}")
+        print("  ".join(cells))
+
+
+def main():
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1, 5, 10, 25])
+    parser.add_argument("--polls", type=int, default=20, help="measured polls per vehicle")
+    parser.add_argument("--warmup", type=int, default=3, help="polls before measuring")
+    parser.add_argument("--latency", type=float, default=0.05, help="feed latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="random extra latency (s)")
+    parser.add_argument("--payload-size", type=int, default=4096, help="feed response size (bytes)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of HTTP 503 responses")
+    parser.add_argument("--transition-every", type=int, default=10,
+                        help="polls between online / asleep transitions")
+    parser.add_argument("--command-every", type=int, default=5,
+                        help="polls between lock / wake commands, 0 to disable")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results = []
+    for vehicles in args.vehicles:
+        results.append(loop.run_until_complete(async_run(vehicles, args)))
+    _print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
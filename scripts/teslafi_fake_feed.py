@@ -0,0 +1,241 @@
+"""Local stand-in for the TeslaFi feed.php API, used by the benchmark."""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import socket
+
+from aiohttp import hdrs, web
+
+"""=================================================================================================================="""
+
+_LOGGER = logging.getLogger(__name__)
+
+ENDPOINT_CURRENT = "current"
+ENDPOINT_LAST_GOOD = "lastGood"
+ENDPOINT_COMMAND = "command"
+
+ENDPOINTS = (ENDPOINT_CURRENT, ENDPOINT_LAST_GOOD, ENDPOINT_COMMAND)
+
+# Fields TeslaFi reports, absent (null) while the vehicle sleeps
+FEED_KEYS = (
+    'id', 'vehicle_id', 'display_name', 'vin', 'state', 'carState', 'Date', 'shift_state',
+    'speed', 'heading', 'power', 'odometer', 'latitude', 'longitude', 'location', 'locked',
+    'battery_level', 'usable_battery_level', 'battery_range', 'est_battery_range',
+    'ideal_battery_range', 'battery_heater_on', 'charging_state', 'charge_enable_request',
+    'charger_actual_current', 'charger_voltage', 'charger_power', 'charger_phases',
+    'charge_energy_added', 'charge_rate', 'charge_limit_soc', 'time_to_full_charge',
+    'inside_temp', 'outside_temp', 'is_climate_on', 'sentry_mode', 'car_version',
+)
+
+"""=================================================================================================================="""
+
+class FakeVehicle:
+    """Simulated vehicle cycling through driving, charging and sleeping"""
+
+    def __init__(self, index, transition_every):
+        """Initialise the vehicle; it sleeps for transition_every polls out of two."""
+        self.index = index
+        self.token = f"bench-token-{index:04d}"
+        self._transition_every = max(2, transition_every)
+        self._polls = 0
+        self._latitude = 45.5 + index * 0.01
+        self._longitude = -73.6
+        self._odometer = 10000.0 + index
+        self._battery_level = 80.0
+        self._energy_added = 0.0
+        self._locked = True
+        self.last_good = None
+
+    @property
+    def awake(self):
+        """Return True during the awake half of the cycle."""
+        return self._polls % (2 * self._transition_every) < self._transition_every
+
+    def wake_up(self):
+        """Start a new awake phase."""
+        if not self.awake:
+            self._polls = 0
+
+    def lock(self, locked):
+        """Lock or unlock the doors."""
+        self._locked = locked
+
+    def poll(self):
+        """Return the current record and move the simulation one poll forward."""
+        if self.awake:
+            record = self._awake_record()
+            self.last_good = record
+        else:
+            record = dict.fromkeys(FEED_KEYS)
+            record.update(state='asleep', carState='Sleeping')
+        self._polls += 1
+        return record
+
+    def _awake_record(self):
+        position = self._polls % (2 * self._transition_every)
+        driving = position < self._transition_every // 2
+        if driving:
+            self._latitude += 0.001
+            self._odometer += 0.07
+            self._battery_level = max(5.0, self._battery_level - 0.05)
+            self._energy_added = 0.0
+        else:
+            self._battery_level = min(100.0, self._battery_level + 0.1)
+            self._energy_added += 0.5
+
+        # TeslaFi reports nearly everything as strings
+        return {
+            'id': str(1000 + self.index),
+            'vehicle_id': str(2000 + self.index),
+            'display_name': f"Bench {self.index}",
+            'vin': f"5YJ3E1EA0BE{self.index:06d}",
+            'state': 'online',
+            'carState': 'Driving' if driving else 'Charging',
+            'Date': f"2019-10-01 12:{self._polls % 60:02d}:00",
+            'shift_state': 'D' if driving else None,
+            'speed': '30' if driving else None,
+            'heading': '0',
+            'power': '15' if driving else '-7',
+            'odometer': f"{self._odometer:.2f}",
+            'latitude': f"{self._latitude:.6f}",
+            'longitude': f"{self._longitude:.6f}",
+            'location': f"Street {self.index}",
+            'locked': '1' if self._locked else '0',
+            'battery_level': str(int(self._battery_level)),
+            'usable_battery_level': str(int(self._battery_level)),
+            'battery_range': f"{self._battery_level * 3:.1f}",
+            'est_battery_range': f"{self._battery_level * 2.8:.1f}",
+            'ideal_battery_range': f"{self._battery_level * 3.2:.1f}",
+            'battery_heater_on': '0',
+            'charging_state': 'Disconnected' if driving else 'Charging',
+            'charge_enable_request': '1',
+            'charger_actual_current': '0' if driving else '32',
+            'charger_voltage': '0' if driving else '240',
+            'charger_power': '0' if driving else '7',
+            'charger_phases': None if driving else '1',
+            'charge_energy_added': f"{self._energy_added:.2f}",
+            'charge_rate': '0' if driving else '25',
+            'charge_limit_soc': '90',
+            'time_to_full_charge': '0' if driving else '1.5',
+            'inside_temp': '21.0',
+            'outside_temp': '12.5',
+            'is_climate_on': '1' if driving else '0',
+            'sentry_mode': '0',
+            'car_version': '2019.32.12',
+        }
+
+"""=================================================================================================================="""
+
+class FakeFeedServer:
+    """aiohttp server answering feed.php like TeslaFi, for a fleet of simulated vehicles"""
+
+    def __init__(self, vehicles=1, latency=0.05, jitter=0.0, payload_size=0, error_rate=0.0,
+                 transition_every=10):
+        """Initialise the server.
+
+        latency, jitter: seconds added to each response.
+        payload_size: responses are padded to about this many bytes.
+        error_rate: share of the requests answered with HTTP 503.
+        transition_every: polls between the online / asleep transitions of the vehicles.
+        """
+        self.vehicles = {}
+        for index in range(vehicles):
+            vehicle = FakeVehicle(index, transition_every)
+            self.vehicles[vehicle.token] = vehicle
+        self._latency = latency
+        self._jitter = jitter
+        self._payload_size = payload_size
+        self._error_rate = error_rate
+        self._runner = None
+        self.url = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Reset the request counters."""
+        self.requests = dict.fromkeys(ENDPOINTS, 0)
+        self.errors = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+    @property
+    def request_count(self):
+        """Return the number of requests since the counters were reset."""
+        return sum(self.requests.values())
+
+    async def async_start(self):
+        """Start listening on a free local port."""
+        app = web.Application()
+        app.router.add_get('/feed.php', self._async_handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        site = web.SockSite(self._runner, sock)
+        await site.start()
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        _LOGGER.debug("Fake TeslaFi feed listening on %s", self.url)
+
+    async def async_stop(self):
+        """Stop the server."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _pad(self, record):
+        """Add filler fields until the body reaches the payload size."""
+        size = len(json.dumps(record))
+        padding = 0
+        while size < self._payload_size:
+            filler = 'x' * min(256, self._payload_size - size)
+            record[f'bench_padding_{padding}'] = filler
+            size += len(filler) + 24
+            padding += 1
+        return record
+
+    async def _async_handle(self, request):
+        vehicle = self.vehicles.get(request.query.get('token'))
+        command = request.query.get('command')
+        if command is None:
+            endpoint = ENDPOINT_CURRENT
+        elif command == 'lastGood':
+            endpoint = ENDPOINT_LAST_GOOD
+        else:
+            endpoint = ENDPOINT_COMMAND
+        self.requests[endpoint] += 1
+
+        await asyncio.sleep(self._latency + random.uniform(0, self._jitter))
+
+        if vehicle is None:
+            return web.Response(status=403)
+        if random.random() < self._error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+
+        if endpoint == ENDPOINT_CURRENT:
+            body = self._pad(vehicle.poll())
+        elif endpoint == ENDPOINT_LAST_GOOD:
+            body = self._pad(dict(vehicle.last_good or dict.fromkeys(FEED_KEYS)))
+        else:
+            body = {'response': self._command(vehicle, command)}
+
+        data = json.dumps(body).encode()
+        etag = '"%s"' % hashlib.blake2b(data, digest_size=8).hexdigest()
+        if request.headers.get(hdrs.IF_NONE_MATCH) == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={hdrs.ETAG: etag})
+        self.bytes_sent += len(data)
+        return web.Response(body=data, content_type='application/json', headers={hdrs.ETAG: etag})
+
+    @staticmethod
+    def _command(vehicle, command):
+        """Apply a command to the vehicle and return its response."""
+        if command == 'wake_up':
+            vehicle.wake_up()
+            return {'result': True, 'state': 'online'}
+        if not vehicle.awake:
+            return {'result': False, 'reason': 'vehicle unavailable: asleep'}
+        if command in ('door_lock', 'door_unlock'):
+            vehicle.lock(command == 'door_lock')
+        return {'result': True, 'reason': ''}